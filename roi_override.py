@@ -6,8 +6,27 @@ ROI Override Tool (concise)
 - Writes new CT series (fresh UIDs) with overrides burned in
 """
 
+import io
 import os
-import glob
+import copy
+import re
+import sys
+import json
+import queue
+import hashlib
+import functools
+import contextlib
+import shutil
+import argparse
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    import resource  # peak RSS for metrics logs (POSIX only)
+except ImportError:
+    resource = None
 import tkinter as tk
 from tkinter import filedialog, messagebox
 
@@ -15,24 +34,64 @@ import customtkinter as ctk
 from CTkListbox import CTkListbox
 
 import pydicom
-from pydicom.uid import generate_uid
+from pydicom.errors import InvalidDicomError
+from pydicom.filereader import read_partial
+from pydicom.dataelem import DataElement
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (generate_uid, CTImageStorage, EnhancedCTImageStorage,
+                         RTStructureSetStorage, ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                         RLELossless, JPEGLosslessSV1, JPEGLSLossless, JPEG2000Lossless)
+try:
+    import pynetdicom  # C-STORE export (optional)
+except ImportError:
+    pynetdicom = None
 import numpy as np
-from PIL import Image, ImageDraw, ImageChops
 from datetime import datetime
 
+# Max distance (mm) along the slice normal between a contour and its CT slice
+SLICE_TOL_MM = 0.01
+
+# Worker threads for per-slice decode/burn/encode (1 = serial)
+WORKERS = min(8, os.cpu_count() or 1)
+
+# Optional on-disk cache of decoded CT volumes + ROI masks (None = off),
+# trimmed least-recently-used first to CACHE_BYTES
+CACHE_DIR = None
+CACHE_BYTES = 8 << 30
+
+# Compression for ZIP output (ZIP_DEFLATED: smaller archives, more CPU)
+ZIP_COMPRESSION = zipfile.ZIP_STORED
+
+# Output layouts: series folders, one ZIP for a run, or one ZIP per image set
+OUTPUT_MODES = ("folder", "zip", "zip-per-set")
+
+# Output formats: uncompressed single-frame CT.<z>.dcm (default), the same
+# RLE Lossless-compressed, or one Enhanced CT multi-frame object per series
+OUTPUT_FORMATS = ("ct", "rle", "enhanced")
+
+# Run folders the GUI writes (ROIOverrideOutput_<timestamp>); never read as input
+OUTPUT_PREFIX = "ROIOverrideOutput_"
+
+# C-STORE export: our AE title, associations per destination, retries per instance
+STORE_AE_TITLE = "ROI_OVERRIDE"
+STORE_CONCURRENCY = 2
+STORE_RETRIES = 2
+
 # ------------------------------
 # Geometry helpers
 # ------------------------------
 def densify_contour(pts: np.ndarray, max_mm: float) -> np.ndarray:
     """Insert points so edges are ≤ max_mm apart (keeps order/closure)."""
-    out = []
-    for i in range(len(pts)):
-        p0 = pts[i]; p1 = pts[(i+1) % len(pts)]
-        seg_len = np.linalg.norm(p1 - p0)
-        steps = max(int(np.ceil(seg_len / max_mm)), 1)
-        for k in range(steps):
-            out.append(p0 + (p1 - p0) * (k / steps))
-    return np.vstack(out)
+    d = np.roll(pts, -1, axis=0) - pts
+    steps = np.maximum(np.ceil(np.linalg.norm(d, axis=1) / max_mm).astype(np.int64), 1)
+    edge = np.repeat(np.arange(len(pts)), steps)
+    k = np.arange(len(edge)) - np.repeat(np.cumsum(steps) - steps, steps)
+    return pts[edge] + d[edge] * (k / steps[edge])[:, None]
+
+def patient_to_pixel(pts: np.ndarray, origin: np.ndarray, spacing: np.ndarray) -> np.ndarray:
+    """Patient x/y (mm) → integer pixel (col,row), truncated like int()."""
+    return ((pts[:, :2] - origin) / spacing).astype(np.int64)
 
 def polygon_area(poly: list[tuple[int,int]]) -> float:
     """Signed area magnitude (unused by burn-in; kept for reference)."""
@@ -44,146 +103,1933 @@ def polygon_area(poly: list[tuple[int,int]]) -> float:
         area += x0*y1 - x1*y0
     return 0.5 * area
 
+# ------------------------------
+# Polygon fill (NumPy scanline)
+# Same pixels as Pillow's ImageDraw.polygon (Draw.c polygon_generic);
+# crossings use float32 like the C code so results match exactly.
+# ------------------------------
+_F32 = np.float32
+
+def _roundf(x: np.ndarray) -> np.ndarray:
+    """C roundf (half away from zero) on float32."""
+    t = np.trunc(x)
+    return t + np.where(np.abs(x - t) >= _F32(0.5), np.sign(x), _F32(0))
+
+def _round_up(x: np.ndarray) -> np.ndarray:
+    """Draw.c ROUND_UP (span start)."""
+    a = np.floor(np.abs(x) + _F32(0.5))
+    return np.where(x >= 0, a, -a).astype(np.int64)
+
+def _round_down(x: np.ndarray) -> np.ndarray:
+    """Draw.c ROUND_DOWN (span end)."""
+    a = np.ceil(np.abs(x) - _F32(0.5))
+    return np.where(x >= 0, a, -a).astype(np.int64)
+
+def _group_starts(*cols: np.ndarray) -> np.ndarray:
+    """True where any of the (sorted) key columns changes."""
+    n = len(cols[0])
+    new = np.zeros(n, dtype=bool)
+    if n:
+        new[0] = True
+        for c in cols:
+            new[1:] |= c[1:] != c[:-1]
+    return new
+
+def _polygon_spans(polys: list[np.ndarray], H: int):
+    """Row spans (poly, y, x_start, x_end) ImageDraw.polygon fills, unclipped.
+
+    All polygons are processed together; each keeps its own edge table,
+    scanline range and corner handling exactly as Draw.c does per call.
+    """
+    n = np.array([len(p) for p in polys])
+    pts = np.concatenate(polys)
+    X, Y = pts[:,0].copy(), pts[:,1].copy()
+    first = np.cumsum(n) - n
+    last = first + n - 1
+
+    # Edges p[j]→p[j+1], then the closing edge if the ring is open
+    pid = np.repeat(np.arange(len(polys)), n)
+    is_last = np.zeros(len(pts), dtype=bool); is_last[last] = True
+    open_ = (X[last] != X[first]) | (Y[last] != Y[first])
+    a = np.flatnonzero(~is_last | open_[pid])
+    ep = pid[a]
+    b = a + 1
+    wrap = is_last[a]
+    b[wrap] = first[ep[wrap]]
+    x0, y0, x1, y1 = X[a], Y[a], X[b], Y[b]
+    lo, hi = np.minimum(y0, y1), np.maximum(y0, y1)
+    flat = lo == hi
+
+    # Scanline range per polygon (Draw.c starts from ysize-1 / 0)
+    starts = np.flatnonzero(_group_starts(ep))
+    ymin = np.clip(np.minimum(np.minimum.reduceat(lo, starts), H - 1), 0, None)
+    ymax = np.minimum(np.maximum(np.maximum.reduceat(hi, starts), 0), H)
+
+    # Horizontal edges are drawn as-is
+    out_p = [ep[flat]]
+    out_y = [lo[flat]]
+    out_x0 = [np.minimum(x0, x1)[flat]]
+    out_x1 = [np.maximum(x0, x1)[flat]]
+
+    # Sloped edges (edge_table), intersected with every scanline they span
+    s = ~flat
+    ep, x0, y0, lo, hi = ep[s], x0[s], y0[s], lo[s], hi[s]
+    dx = (x1[s] - x0).astype(_F32) / (y1[s] - y0).astype(_F32)
+    fx0 = x0.astype(_F32)
+    ra, rb = np.maximum(lo, ymin[ep]), np.minimum(hi, ymax[ep])
+    cnt = np.clip(rb - ra + 1, 0, None)
+    e = np.repeat(np.arange(len(dx)), cnt)
+    y = ra[e] + np.arange(len(e)) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+    xx = (y - y0[e]).astype(_F32) * dx[e] + fx0[e]
+
+    # An edge ending above the last scanline is counted twice
+    dup = (y == hi[e]) & (y < ymax[ep[e]])
+
+    # Other endpoint rows: "connect discontiguous corners" against the first
+    # earlier edge of the same polygon that meets this one at the corner
+    corner = ~dup & ((y == lo[e]) | (y == hi[e])) & (dx[e] != 0)
+    if corner.any():
+        k = np.repeat(np.flatnonzero(dx != 0), 2)      # both endpoints, k ascending
+        ky = np.where(np.arange(len(k)) % 2 == 0, lo[k], hi[k])
+        kside = (np.arange(len(k)) % 2 == 0).astype(np.int64)
+        kr = _roundf((ky - y0[k]).astype(_F32) * dx[k] + fx0[k]).astype(np.int64)
+
+        c = np.flatnonzero(corner)
+        ci, cy = e[c], y[c]
+        off = np.where(cy == hi[ci], -1, 1)
+        cr = _roundf(xx[c]).astype(np.int64)
+
+        # Pack (polygon, row, side, rounded x) into one sortable key;
+        # ties sort by edge so the first match is the earliest edge
+        ylo, rlo = min(ky.min(), cy.min()), min(kr.min(), cr.min())
+        ny, nr = max(ky.max(), cy.max()) - ylo + 1, max(kr.max(), cr.max()) - rlo + 1
+        def key(p, yv, side, r):
+            return ((p.astype(np.int64) * ny + (yv - ylo)) * 2 + side) * nr + (r - rlo)
+        rkey = key(ep[k], ky, kside, kr)
+        srt = np.argsort(rkey * len(dx) + k)
+        rkey, rk = rkey[srt], k[srt]
+
+        q = key(ep[ci], cy, (off > 0).astype(np.int64), cr)
+        pos = np.minimum(np.searchsorted(rkey, q), len(rkey) - 1)
+        hit = (rkey[pos] == q) & (rk[pos] < ci)
+
+        c, ci, ck, yo = c[hit], ci[hit], rk[pos][hit], (cy + off)[hit]
+        v = xx[c]
+        adj   = (yo - y0[ci]).astype(_F32) * dx[ci] + fx0[ci]
+        adj_o = (yo - y0[ck]).astype(_F32) * dx[ck] + fx0[ck]
+        right = (v > adj + 1) & (v > adj_o + 1)
+        left  = ~right & (v < adj - 1) & (v < adj_o - 1)
+        v = np.where(right, _roundf(np.maximum(adj, adj_o)) + 1, v)
+        xx[c] = np.where(left, _roundf(np.minimum(adj, adj_o)) - 1, v)
+
+    p  = np.concatenate([ep[e], ep[e][dup]])
+    y  = np.concatenate([y, y[dup]])
+    xx = np.concatenate([xx, xx[dup]])
+
+    # Sort each polygon's row crossings and fill between consecutive pairs
+    # (float32 bits mapped to an order-preserving int for a packed key)
+    bits = xx.view(np.int32).astype(np.int64)
+    bits ^= (bits >> 31) & 0x7FFFFFFF
+    srt = np.argsort((p.astype(np.int64) * (H + 2 + int(ymax.max()) - int(ymin.min())) + (y - int(ymin.min()))) << 32
+                     | (bits + (1 << 31)))
+    p, y, xx = p[srt], y[srt], xx[srt]
+    idx = np.arange(len(y))
+    rank = idx - np.maximum.accumulate(np.where(_group_starts(p, y), idx, 0))
+    pair = np.flatnonzero((rank[:-1] % 2 == 0) & (p[1:] == p[:-1]) & (y[1:] == y[:-1]))
+    out_p.append(p[pair]); out_y.append(y[pair])
+    out_x0.append(_round_up(xx[pair])); out_x1.append(_round_down(xx[pair + 1]))
+
+    return (np.concatenate(out_p), np.concatenate(out_y),
+            np.concatenate(out_x0), np.concatenate(out_x1))
+
+def rasterize_polygons(polys: list, shape: tuple[int,int]) -> np.ndarray:
+    """Even-odd fill of one slice's pixel polygons (outline included).
+
+    Same pixels as drawing each polygon with ImageDraw.polygon(outline=1,
+    fill=1) and XOR-ing the results, without any full-frame temporaries:
+    spans are built for all polygons at once and only the polygons'
+    bounding box is touched.
+    """
+    H, W = shape
+    mask = np.zeros((H, W), dtype=bool)
+    polys = [np.asarray(poly, dtype=np.int32).reshape(-1, 2) for poly in polys]
+    polys = [poly for poly in polys if len(poly) >= 2]
+    if not polys:
+        return mask
+    p, y, x0, x1 = _polygon_spans(polys, H)
+
+    # Clip like ImageDraw's hline
+    x0, x1 = np.maximum(x0, 0), np.minimum(x1, W - 1)
+    keep = (y >= 0) & (y < H) & (x0 <= x1)
+    p, y, x0, x1 = p[keep], y[keep], x0[keep], x1[keep]
+    if not len(y):
+        return mask
+
+    # Merge each polygon's spans per row into disjoint runs [x0, end)
+    srt = np.argsort((p.astype(np.int64) * H + y) * W + x0)
+    p, y, x0, x1 = p[srt], y[srt], x0[srt], x1[srt]
+    row = np.cumsum(_group_starts(p, y)) * (W + 1)
+    reach = np.maximum.accumulate(x1 + row) - row
+    new = np.ones(len(y), dtype=bool)
+    new[1:] = (row[1:] != row[:-1]) | (x0[1:] > reach[:-1])
+    end = reach[np.r_[new[1:], True]] + 1
+    y, x0 = y[new], x0[new]
+
+    # Pixel parity over all runs = XOR across polygons
+    r0, r1 = int(y.min()), int(y.max()) + 1
+    c0, c1 = int(x0.min()), int(end.max())
+    w = c1 - c0 + 1
+    flips = np.bincount(np.concatenate([(y - r0) * w + (x0 - c0), (y - r0) * w + (end - c0)]),
+                        minlength=(r1 - r0) * w).astype(np.uint8) & 1
+    cover = np.bitwise_xor.accumulate(flips.reshape(r1 - r0, w), axis=1)
+    mask[r0:r1, c0:c1] = cover[:, :-1].view(bool)
+    return mask
+
+# ------------------------------
+# Input sources (folders, nested trees, ZIP archives)
+# ------------------------------
+# An input file is a path, or "<archive>.zip!/<member>" for a ZIP member;
+# members are read in place through zipfile (never extracted).
+_MEMBER = re.compile(r"(.+?\.zip)!/(.+)", re.IGNORECASE)
+
+# Open archives by (path, mtime/size stamp, pid), closed when the last
+# reading run ends (see _reading_inputs)
+_ZIPS: dict = {}
+_ZIPS_LOCK = threading.Lock()
+_ZIP_READERS = 0
+
+def _zip(path: str, stamp: tuple, pid: int) -> zipfile.ZipFile:
+    """Open archive, reused while its mtime/size `stamp` is unchanged.
+
+    Keyed by process too: a forked worker must not share the parent's file offset.
+    """
+    with _ZIPS_LOCK:
+        zf = _ZIPS.get((path, stamp, pid))
+        if zf is None:
+            zf = _ZIPS[path, stamp, pid] = zipfile.ZipFile(path)
+        return zf
+
+@contextlib.contextmanager
+def _reading_inputs():
+    """Scope (or decorator) of a run that reads inputs: the archives opened
+    meanwhile are closed once no run in this process is reading, so none
+    stays open (locked on Windows) after a run."""
+    global _ZIP_READERS
+    with _ZIPS_LOCK:
+        _ZIP_READERS += 1
+    try:
+        yield
+    finally:
+        with _ZIPS_LOCK:
+            _ZIP_READERS -= 1
+            if not _ZIP_READERS:
+                for zf in _ZIPS.values():
+                    zf.close()
+                _ZIPS.clear()
+
+def _member(src: str) -> "tuple[zipfile.ZipFile, zipfile.ZipInfo] | None":
+    """(archive, member info) for a ZIP member reference; None for a plain path."""
+    m = _MEMBER.fullmatch(src)
+    if m is None:
+        return None
+    st = os.stat(m[1])
+    zf = _zip(m[1], (st.st_mtime_ns, st.st_size), os.getpid())
+    return zf, zf.getinfo(m[2])
+
+def open_source(src: str):
+    """Binary, seekable file object for an input file or ZIP member."""
+    member = _member(src)
+    return open(src, "rb") if member is None else member[0].open(member[1])
+
+def read_dataset(src: str, **kwargs):
+    """pydicom.dcmread for an input file or ZIP member."""
+    if _member(src) is None:
+        return pydicom.dcmread(src, **kwargs)
+    with open_source(src) as fh:
+        ds = pydicom.dcmread(fh, **kwargs)
+    ds.buffer = None  # the closed member stream (keeps the dataset picklable)
+    return ds
+
+def source_stamp(src: str) -> list:
+    """[name, mtime_ns, size] of an input (cache keys, newest-RTSTRUCT choice).
+
+    ZIP members use their (2 s resolution) entry time and add their CRC.
+    """
+    member = _member(src)
+    if member is None:
+        st = os.stat(src)
+        return [os.path.basename(src), st.st_mtime_ns, st.st_size]
+    info = member[1]
+    mtime = int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+    return [os.path.basename(info.filename), mtime, info.file_size, info.CRC]
+
+def source_mtime(src: str):
+    return source_stamp(src)[1]
+
+def source_size(src: str) -> int:
+    return source_stamp(src)[2]
+
+def iter_sources(root: str):
+    """Lazily yield input files under a folder (recursively) or ZIP, in sorted order.
+
+    ZIP archives (the root, or *.zip found in the tree) yield their members.
+    Files are not filtered by name (scan_folder classifies by header), but
+    ROIOverrideOutput_* folders from earlier runs are skipped.
+    """
+    if os.path.isfile(root):
+        if zipfile.is_zipfile(root):
+            with zipfile.ZipFile(root) as zf:
+                names = sorted(i.filename for i in zf.infolist() if not i.is_dir())
+            yield from (f"{root}!/{n}" for n in names)
+        return
+    for d, dirs, files in os.walk(root):
+        dirs[:] = sorted(x for x in dirs if not x.startswith(OUTPUT_PREFIX))
+        for f in sorted(files):
+            path = os.path.join(d, f)
+            if f.lower().endswith(".zip"):
+                yield from iter_sources(path)
+            else:
+                yield path
+
+# ------------------------------
+# Input discovery + shared CT series
+# ------------------------------
+# Partial reads stop at these tags: a file header ends after ImagePositionPatient
+# (modality, SOP class, study/series UIDs, z); a structure set before
+# ROIContourSequence, so ROI names and references come without contour data.
+_HEADER_END = pydicom.tag.Tag(0x0020, 0x0032)
+_ROI_CONTOURS = pydicom.tag.Tag(0x3006, 0x0039)
+
+def peek_header(path: str, stop_after=_HEADER_END):
+    """Leading elements of a DICOM file up to `stop_after`; None if not DICOM."""
+    try:
+        with open_source(path) as fh:
+            return read_partial(fh, stop_when=lambda tag, vr, length: tag > stop_after)
+    except (InvalidDicomError, OSError, EOFError, zipfile.BadZipFile):
+        return None
+
+def read_structure_set(path: str):
+    """RTSTRUCT without ROIContourSequence (ROI names + references only)."""
+    with open_source(path) as fh:
+        return read_partial(fh, stop_when=lambda tag, vr, length: tag >= _ROI_CONTOURS)
+
+def contour_points(ctr) -> np.ndarray:
+    """A contour item's ContourData as (N, 3) floats, parsed from the raw
+    bytes when still deferred (no per-number DSfloat objects)."""
+    value = ctr.get_item("ContourData").value
+    if isinstance(value, bytes):
+        value = value.rstrip(b" \x00").decode("ascii").split("\\")
+    return np.array(value, dtype=float).reshape(-1, 3)
+
+def dicom_kind(ds) -> "str | None":
+    """"CT", "RTSTRUCT" or None for a (peeked) header, by SOP Class then Modality."""
+    if ds is None:
+        return None
+    sop_class, modality = ds.get("SOPClassUID"), ds.get("Modality")
+    if sop_class == CTImageStorage or (sop_class is None and modality == "CT"):
+        return "CT"
+    if sop_class == RTStructureSetStorage or modality == "RTSTRUCT":
+        return "RTSTRUCT"
+    return None
+
+def scan_folder(input_dir: str) -> tuple[dict, dict]:
+    """Classify DICOM files under a folder or ZIP by header (see iter_sources).
+
+    → ({CT path: hdr}, {RTSTRUCT path: hdr}); paths may be ZIP member references.
+    """
+    ct, rs = {}, {}
+    for f in iter_sources(input_dir):
+        ds = peek_header(f)
+        kind = dicom_kind(ds)
+        if kind == "CT":
+            ct[f] = ds
+        elif kind == "RTSTRUCT":
+            rs[f] = ds
+    return ct, rs
+
+def referenced_series(ct_hdrs: dict, rs) -> dict:
+    """The CTs of ct_hdrs ({path: hdr}) in the series the RTSTRUCT `rs` (see
+    read_structure_set; None: no RTSTRUCT) references through
+    RTReferencedSeriesSequence; all of them if it names none. Raises
+    RuntimeError unless exactly one CT series remains.
+    """
+    refs = set()
+    for ref in getattr(rs, "ReferencedFrameOfReferenceSequence", []):
+        for st in getattr(ref, "RTReferencedStudySequence", []):
+            for se in getattr(st, "RTReferencedSeriesSequence", []):
+                refs.add(se.get("SeriesInstanceUID"))
+    if refs:
+        ct_hdrs = {f: ds for f, ds in ct_hdrs.items() if ds.get("SeriesInstanceUID") in refs}
+        if not ct_hdrs:
+            raise RuntimeError("No CT of the series the RTSTRUCT references")
+    uids = {ds.get("SeriesInstanceUID") for ds in ct_hdrs.values()}
+    if len(uids) > 1:
+        raise RuntimeError(f"Several CT series to choose from ({len(uids)}); "
+                           "keep one per input or reference one from the RTSTRUCT")
+    return ct_hdrs
+
+def select_input(input_dir: str) -> tuple[dict, "str | None", "Dataset | None"]:
+    """Inputs of a run: ({CT path: hdr} of one series, RTSTRUCT path, its
+    structure set without contours), the last two None without an RTSTRUCT.
+
+    The newest RTSTRUCT wins; CTs are narrowed to the series it references
+    (see referenced_series). Scan once and pass the result to the loaders
+    (`inputs=`) to reuse it.
+    """
+    ct_hdrs, rs_hdrs = scan_folder(input_dir)
+    if not ct_hdrs:
+        raise RuntimeError(f"Missing CT in {input_dir}")
+    rs_path = max(rs_hdrs, key=source_mtime) if rs_hdrs else None
+    rs = read_structure_set(rs_path) if rs_path else None
+    return referenced_series(ct_hdrs, rs), rs_path, rs
+
+def find_dicom_files(input_dir: str) -> tuple[list[str], list[str]]:
+    """Split the DICOM files under a folder or ZIP into (CT files, RTSTRUCT files) by header."""
+    ct, rs = scan_folder(input_dir)
+    return list(ct), list(rs)
+
+def z_key(z: float) -> str:
+    """Slice key naming output files (CT.<z>.dcm); one output per key."""
+    return f"{z:.2f}".replace("-0.00","0.00")
+
+def slice_normal(ds) -> np.ndarray:
+    """Unit normal of an image plane from ImageOrientationPatient (axial if absent)."""
+    iop = np.array([float(v) for v in getattr(ds, "ImageOrientationPatient", [1, 0, 0, 0, 1, 0])])
+    n = np.cross(iop[:3], iop[3:])
+    return n / np.linalg.norm(n)
+
+class CTSeries:
+    """CT series decoded once (headers, stored pixel volume, scaling/dtype).
+
+    Pixels stay in each slice's stored-value domain (HU = raw * slope +
+    intercept); burn-in converts target HU per slice instead. Shared
+    read-only by every burn-in task; tasks write into a `view()`.
+    Slice i comes from files[i] and has key z_keys[i]; `kept` lists one
+    slice per key (the last, if a z repeats). Contours find their slice
+    with find_slices. A headers-only series (see load_ct_headers) has
+    pixels=None. The loaders set `rtstruct`, the structure set chosen with
+    the series (see select_input), and `cache_key` (see series_cache_key).
+    Headers are never modified after loading.
+    """
+    def __init__(self, files, headers, pixels, slopes, intercepts, dtypes):
+        self.files      = files
+        self.headers    = headers
+        self.pixels     = pixels
+        self.slopes     = slopes
+        self.intercepts = intercepts
+        self.dtypes     = dtypes
+        self.z_keys     = [z_key(float(ds.ImagePositionPatient[2])) for ds in headers]
+        self.origins    = np.array([[float(v) for v in ds.ImagePositionPatient[:2]] for ds in headers])
+        self.spacings   = np.array([[float(v) for v in ds.PixelSpacing] for ds in headers])
+        last            = {z: i for i, z in enumerate(self.z_keys)}
+        self.kept       = [i for i, z in enumerate(self.z_keys) if last[z] == i]
+        # Numeric slice index: kept slices sorted by position along the normal
+        self.normal     = slice_normal(headers[0])
+        pos = np.array([[float(v) for v in ds.ImagePositionPatient] for ds in headers]) @ self.normal
+        order = sorted(self.kept, key=lambda i: pos[i])
+        self.sorted_slices = np.array(order, dtype=np.int64)
+        self.positions  = pos[order]
+        # Load-stage metrics, filled in by the loader (see run_roi_override)
+        self.stats      = {}
+        self.rtstruct   = None
+        self.cache_key  = None
+        if pixels is not None:
+            self.pixels.flags.writeable = False
+
+    def __len__(self):
+        return len(self.files)
+
+    def find_slices(self, d: np.ndarray, tol: float = SLICE_TOL_MM) -> np.ndarray:
+        """Slice index for each position `d` along the normal; -1 beyond `tol` mm.
+
+        Binary search over the sorted positions (nearest slice wins).
+        """
+        d = np.asarray(d, dtype=np.float64)
+        n = len(self.positions)
+        if n == 0:
+            return np.full(d.shape, -1, dtype=np.int64)
+        j = np.searchsorted(self.positions, d)
+        lo, hi = np.clip(j - 1, 0, n - 1), np.clip(j, 0, n - 1)
+        near = np.where(np.abs(self.positions[hi] - d) < np.abs(self.positions[lo] - d), hi, lo)
+        return np.where(np.abs(self.positions[near] - d) <= tol, self.sorted_slices[near], -1)
+
+    def view(self) -> "PixelView":
+        return PixelView(self)
+
+class PixelView:
+    """Copy-on-write pixel slices over a CTSeries (copies a slice on first write)."""
+    def __init__(self, series: CTSeries):
+        self.series = series
+        self.written: dict[int, np.ndarray] = {}
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        raw = self.written.get(i)
+        return self.series.pixels[i] if raw is None else raw
+
+    def writable(self, i: int) -> np.ndarray:
+        raw = self.written.get(i)
+        if raw is None:
+            raw = self.written[i] = self.series.pixels[i].astype(self.series.dtypes[i])
+        return raw
+
+class BurnInCancelled(Exception):
+    """Raised once a run's `cancel` event is set."""
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise BurnInCancelled()
+
+def _stage(progress, stage: str):
+    """Adapt progress(stage, done, total) to pool_map's progress(done, total)."""
+    if progress is None:
+        return None
+    return lambda done, total: progress(stage, done, total)
+
+def pool_map(fn, *iterables, workers: int = 1, processes: bool = False,
+             progress=None, cancel=None, consume=None) -> list:
+    """Ordered map over a thread (or process) pool; inline when workers ≤ 1.
+
+    progress(done, total) is called as items finish. Once `cancel` (a
+    threading.Event) is set, no new items start and BurnInCancelled is
+    raised after the running ones finish. consume(i, result), if given,
+    gets each result in input order in the calling thread; its return
+    value is kept instead.
+    """
+    jobs = list(zip(*iterables))
+    results = []
+    def collect(r):
+        if consume is not None:
+            r = consume(len(results), r)
+        results.append(r)
+        if progress:
+            progress(len(results), len(jobs))
+
+    if workers <= 1:
+        for args in jobs:
+            _check_cancel(cancel)
+            collect(fn(*args))
+        return results
+
+    # At most 2× workers items in flight, each future dropped once collected,
+    # so finished results never pile up ahead of consume()
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    ex = pool(max_workers=workers)
+    pending = deque()
+    try:
+        for args in jobs:
+            _check_cancel(cancel)
+            pending.append(ex.submit(fn, *args))
+            if len(pending) >= 2 * workers:
+                collect(pending.popleft().result())
+        while pending:
+            _check_cancel(cancel)
+            collect(pending.popleft().result())
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+    return results
+
+def _stage_start(metrics: bool = False) -> tuple[float, bool]:
+    """(perf_counter(), peak reset) at the start of a stage. With `metrics`,
+    on Linux, the process-wide peak RSS is reset (clear_refs → VmHWM) so
+    peak_rss_mb covers the stage; this also affects other threads' stages
+    and any embedding code, so it is only done when metrics are asked for."""
+    reset = False
+    if metrics:
+        try:
+            with open("/proc/self/clear_refs", "w") as fh:
+                fh.write("5")
+            reset = True
+        except OSError:
+            pass
+    return time.perf_counter(), reset
+
+def peak_rss_mb() -> "float | None":
+    """Peak resident set size of the whole process in MiB: since the last
+    reset (see _stage_start) on Linux, else over its lifetime (None where
+    unknown)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # bytes on macOS, KiB elsewhere
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def _stage_stats(start: tuple[float, bool], **counts) -> dict:
+    """Metrics record for a stage begun at `start` (see _stage_start):
+    seconds, process peak RSS and what it spans, counts."""
+    t0, reset = start
+    return {"seconds": round(time.perf_counter() - t0, 4), "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_since": "stage start" if reset else "process start", **counts}
+
+def _pixel_dtype(ds) -> np.dtype:
+    """Stored pixel dtype from the header (as pydicom decodes it)."""
+    return np.dtype(f"{'i' if getattr(ds, 'PixelRepresentation', 0) else 'u'}{ds.BitsAllocated // 8}")
+
+def _decode(ds) -> np.ndarray:
+    """ds.pixel_array, without leaving pydicom's decoded copy cached on ds."""
+    arr = ds.pixel_array
+    ds._pixel_array, ds._pixel_id = None, {}
+    return arr
+
+def _read_slice(path: str):
+    """dcmread + decode one CT → (header, stored pixels, slope, intercept)."""
+    ds = read_dataset(path)
+    slope = float(getattr(ds, "RescaleSlope", 1.0))
+    intercept = float(getattr(ds, "RescaleIntercept", 0.0))
+    return ds, _decode(ds), slope, intercept
+
+def load_ct_series(input_dir: str, workers: int = 1, processes: bool = False,
+                   progress=None, cancel=None, cache_dir: "str | None" = None,
+                   metrics: bool = False, inputs: "tuple | None" = None) -> CTSeries:
+    """Read + decode every CT slice in a folder into a shared CTSeries.
+
+    With `cache_dir`, the pixel volume is memory-mapped from the cache when the
+    series is unchanged (only headers are read), and cached otherwise.
+    progress(stage, done, total) reports per slice as stage "load".
+    `metrics` measures the stage's own peak RSS (see _stage_start).
+    `inputs`: the folder's select_input result, if already scanned.
+    """
+    t0 = _stage_start(metrics)
+    ct_hdrs, rs_path, _ = inputs or select_input(input_dir)
+    ct_fs = list(ct_hdrs)
+    read = {"files_read": len(ct_fs), "bytes_read": sum(map(source_size, ct_fs))}
+
+    pool = {"workers": workers, "processes": processes,
+            "progress": _stage(progress, "load"), "cancel": cancel}
+    key = series_cache_key(ct_hdrs)
+    entry = _cache_entry(cache_dir, key) if cache_dir else None
+    if entry is not None:
+        series = _load_cached_series(entry, ct_fs, pool)
+        if series is not None:
+            series.rtstruct, series.cache_key = rs_path, key
+            series.stats = _stage_stats(t0, **read, cached=True)
+            return series
+
+    # Each slice is copied into one volume as it arrives and then released
+    # (widened if a later slice's dtype needs it, as np.stack would)
+    volume = None
+    def collect(i, item):
+        nonlocal volume
+        ds, raw, slope, intercept = item
+        if volume is None:
+            volume = np.empty((len(ct_fs),) + raw.shape, raw.dtype)
+        elif np.result_type(volume.dtype, raw.dtype) != volume.dtype:
+            volume = volume.astype(np.result_type(volume.dtype, raw.dtype))
+        volume[i] = raw
+        return ds, raw.dtype, slope, intercept
+
+    slices = pool_map(_read_slice, ct_fs, consume=collect, **pool)
+    headers, dtypes, slopes, intercepts = (list(c) for c in zip(*slices))
+    series = CTSeries(ct_fs, headers, volume, slopes, intercepts, dtypes)
+    if entry is not None:
+        _cache_series(cache_dir, entry, series)
+    series.rtstruct, series.cache_key = rs_path, key
+    series.stats = _stage_stats(t0, **read, cached=False)
+    return series
+
+def _read_header(path: str):
+    return read_dataset(path, stop_before_pixels=True)
+
+def load_ct_headers(input_dir: str, workers: int = 1, processes: bool = False,
+                    progress=None, cancel=None, metrics: bool = False,
+                    inputs: "tuple | None" = None) -> CTSeries:
+    """Headers-only CTSeries (slice geometry, no pixels) for streaming runs
+    (`metrics`, `inputs`: see load_ct_series)."""
+    t0 = _stage_start(metrics)
+    ct_hdrs, rs_path, _ = inputs or select_input(input_dir)
+    ct_fs = list(ct_hdrs)
+
+    headers = pool_map(_read_header, ct_fs, workers=workers, processes=processes,
+                       progress=_stage(progress, "load"), cancel=cancel)
+    slopes = [float(getattr(ds, "RescaleSlope", 1.0)) for ds in headers]
+    intercepts = [float(getattr(ds, "RescaleIntercept", 0.0)) for ds in headers]
+    series = CTSeries(ct_fs, headers, None, slopes, intercepts, [_pixel_dtype(ds) for ds in headers])
+    series.rtstruct, series.cache_key = rs_path, series_cache_key(ct_hdrs)
+    series.stats = _stage_stats(t0, files_read=len(ct_fs), headers_only=True)
+    return series
+
+# ------------------------------
+# Optional on-disk cache (decoded pixel volumes + ROI masks)
+# ------------------------------
+# One entry folder per CT series: pixels.npy + meta.json, and masks/ holding one
+# packed-bit file per (RTSTRUCT, ROI, outline|fill). Bump on format changes.
+_CACHE_VERSION = 4
+
+def _file_stamps(paths) -> list:
+    return [source_stamp(p) for p in paths]
+
+def series_cache_key(ct_hdrs: dict) -> str:
+    """Cache key of a CT series: series UID(s) + file names, mtimes and sizes."""
+    uids = sorted({str(ds.get("SeriesInstanceUID", "")) for ds in ct_hdrs.values()})
+    blob = json.dumps([_CACHE_VERSION, uids, _file_stamps(sorted(ct_hdrs))])
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+def _cache_entry(cache_dir: str, key: str) -> str:
+    """Entry folder for key, touched on use (LRU order = folder mtime)."""
+    path = os.path.join(cache_dir, key)
+    os.makedirs(os.path.join(path, "masks"), exist_ok=True)
+    os.utime(path)
+    return path
+
+def _atomic_save(path: str, save):
+    """save(fh) into a temp file, then rename (safe with concurrent runs)."""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as fh:
+        save(fh)
+    os.replace(tmp, path)
+
+def _dir_size(path: str) -> int:
+    size = 0
+    for d, _, fs in os.walk(path):
+        for f in fs:
+            try:
+                size += os.path.getsize(os.path.join(d, f))
+            except OSError:
+                pass
+    return size
+
+def evict_cache(cache_dir: str, max_bytes: int = CACHE_BYTES, keep: "str | None" = None):
+    """Remove least-recently-used entries until the cache fits max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            entries.append((os.path.getmtime(path), _dir_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+def _cache_series(cache_dir: str, entry: str, series: CTSeries):
+    meta = {"files": [os.path.basename(f) for f in series.files],
+            "slopes": series.slopes, "intercepts": series.intercepts,
+            "dtypes": [np.dtype(d).str for d in series.dtypes]}
+    _atomic_save(os.path.join(entry, "pixels.npy"), lambda fh: np.save(fh, series.pixels))
+    _atomic_save(os.path.join(entry, "meta.json"), lambda fh: fh.write(json.dumps(meta).encode()))
+    evict_cache(cache_dir, CACHE_BYTES, keep=entry)
+
+def _load_cached_series(entry: str, ct_fs: list[str], pool: dict) -> "CTSeries | None":
+    """CTSeries from a cache entry (files read, not decoded; pixels memory-mapped); None on miss."""
+    try:
+        with open(os.path.join(entry, "meta.json"), encoding="utf-8") as fh:
+            meta = json.load(fh)
+        pixels = np.load(os.path.join(entry, "pixels.npy"), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if meta["files"] != [os.path.basename(f) for f in ct_fs] or len(pixels) != len(ct_fs):
+        return None
+
+    headers = pool_map(read_dataset, ct_fs, **pool)
+    return CTSeries(ct_fs, headers, pixels, meta["slopes"], meta["intercepts"],
+                    [np.dtype(d) for d in meta["dtypes"]])
+
+def _load_masks(path: str) -> "tuple[dict[int, tuple], int] | None":
+    """({slice: row-band mask}, unmatched contours) cached at path, or None."""
+    try:
+        with np.load(path) as z:
+            slices, rows, sizes, bits = z["slices"], z["rows"], z["sizes"], z["bits"]
+            unmatched = int(z["unmatched"])
+    except (OSError, ValueError, KeyError):
+        return None
+    os.utime(os.path.dirname(os.path.dirname(path)))
+    bands = zip(rows.tolist(), np.split(bits, np.cumsum(sizes)[:-1]))
+    return dict(zip(slices.tolist(), bands)), unmatched
+
+def _save_masks(path: str, masks: dict[int, tuple], unmatched: int):
+    slices = sorted(masks)
+    parts = [masks[i][1] for i in slices]
+    _atomic_save(path, lambda fh: np.savez(
+        fh, slices=np.array(slices, dtype=np.int64),
+        rows=np.array([masks[i][0] for i in slices], dtype=np.int64),
+        sizes=np.array([len(b) for b in parts], dtype=np.int64),
+        bits=np.concatenate(parts) if parts else np.zeros(0, np.uint8),
+        unmatched=np.int64(unmatched)))
+
+# ------------------------------
+# Output encodings (RLE Lossless, Enhanced CT)
+# ------------------------------
+def _chunks(start: np.ndarray, length: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Split byte ranges into consecutive ranges of ≤128 (one PackBits packet each)."""
+    n = (length + 127) // 128
+    j = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    return np.repeat(start, n) + 128 * j, np.minimum(128, np.repeat(length, n) - 128 * j)
+
+def _packbits_rows(plane: np.ndarray) -> bytes:
+    """PackBits-encode a 2-D uint8 plane (one RLE segment, PS3.5 Annex G).
+
+    Vectorized: runs of ≥3 equal bytes become replicate packets, the bytes
+    between them literal packets; packets hold ≤128 bytes and never cross
+    a row. Padded to even length.
+    """
+    W = plane.shape[1]
+    b = plane.ravel()
+    n = b.size
+    new = np.ones(n, bool)
+    new[1:] = b[1:] != b[:-1]
+    new[::W] = True
+    starts = np.flatnonzero(new)
+    lens = np.diff(starts, append=n)
+    repl = lens >= 3
+    r_start, r_len = _chunks(starts[repl], lens[repl])
+
+    # Literal stretches: consecutive non-replicate runs within a row
+    lit_runs = np.flatnonzero(~repl)
+    first = (np.concatenate(([True], repl[:-1])) | (starts % W == 0))[lit_runs]
+    s_len = np.add.reduceat(lens[lit_runs], np.flatnonzero(first)) if lit_runs.size else lens[:0]
+    l_start, l_len = _chunks(starts[lit_runs[first]], s_len)
+
+    # Output = literal bytes + one value per replicate packet, with each
+    # packet's header byte inserted in front, in source order
+    pos = np.concatenate([r_start, l_start])
+    head = np.concatenate([257 - r_len, l_len - 1]).astype(np.uint8)
+    order = np.argsort(pos)
+    keep = np.repeat(~repl, lens)
+    keep[r_start] = True
+    out = np.insert(b[keep], np.searchsorted(np.flatnonzero(keep), pos[order]), head[order])
+    if out.size % 2:
+        out = np.append(out, np.uint8(0))
+    return out.tobytes()
+
+def rle_frame(pixels: np.ndarray) -> bytes:
+    """One RLE Lossless frame of a 2-D integer image (segments = bytes, MSB first)."""
+    le = pixels.astype(pixels.dtype.newbyteorder("<"), copy=False)
+    planes = np.ascontiguousarray(le).view(np.uint8).reshape(*pixels.shape, -1)
+    segments = [_packbits_rows(np.ascontiguousarray(planes[..., k]))
+                for k in reversed(range(planes.shape[-1]))]
+    header = np.zeros(16, "<u4")
+    header[0] = len(segments)
+    header[1:len(segments) + 1] = 64 + np.cumsum([0] + [len(seg) for seg in segments[:-1]])
+    return header.tobytes() + b"".join(segments)
+
+# save_as keyword for a conformant file (preamble + File Meta Information);
+# pydicom 3 renamed pydicom 2's write_like_original=False
+_FILE_FORMAT = ({"enforce_file_format": True} if int(pydicom.__version__.split(".")[0]) >= 3
+                else {"write_like_original": False})
+
+def _save(ds, path: "str | None", file_format: bool = False):
+    """ds.save_as(path) (file_format: see _FILE_FORMAT); path=None returns
+    the encoded file bytes instead."""
+    kwargs = _FILE_FORMAT if file_format else {}
+    if path is not None:
+        return ds.save_as(path, **kwargs)
+    buf = io.BytesIO()
+    ds.save_as(buf, **kwargs)
+    return buf.getvalue()
+
+def _derive(ds):
+    """Per-write copy of a (shared) header: its own element dicts, with the
+    elements themselves still shared, so set them with _replace only."""
+    out = copy.copy(ds)
+    out._dict = dict(ds._dict)
+    meta = copy.copy(ds.file_meta)
+    meta._dict = dict(ds.file_meta._dict)
+    out.file_meta = meta
+    return out
+
+def _replace(ds, kw: str, value):
+    """Set kw on a _derive copy as a new element (setattr would change the shared one)."""
+    if kw in ds:
+        delattr(ds, kw)
+    setattr(ds, kw, value)
+
+def _save_rle(ds, pixels: np.ndarray, path: "str | None"):
+    """Save ds (a _derive copy) with `pixels` as RLE Lossless."""
+    ds["PixelData"] = DataElement(0x7FE00010, "OB", encapsulate([rle_frame(pixels)]),
+                                  is_undefined_length=True)
+    _replace(ds.file_meta, "TransferSyntaxUID", RLELossless)
+    return _save(ds, path)
+
+def _window(raw: np.ndarray, slope: float, intercept: float) -> tuple[int, int]:
+    """(WindowCenter, WindowWidth) spanning a stored-pixel slice's HU range."""
+    lo, hi = sorted((float(raw.min()) * slope + intercept, float(raw.max()) * slope + intercept))
+    return int((hi + lo) / 2), int(max(hi - lo, 1))
+
+def _first(v):
+    return v[0] if isinstance(v, pydicom.multival.MultiValue) else v
+
+def _enhanced_frame(k: int, pixels: np.ndarray, burned: bool, slope: float, intercept: float,
+                    window: tuple, position) -> tuple[bytes, Dataset]:
+    """(pixel bytes, per-frame functional groups) of Enhanced CT frame k."""
+    pos = Dataset()
+    pos.ImagePositionPatient = position
+    content = Dataset()
+    content.StackID, content.InStackPositionNumber = "1", k + 1
+    content.DimensionIndexValues = [k + 1]
+    scaling = Dataset()
+    scaling.RescaleIntercept, scaling.RescaleSlope, scaling.RescaleType = intercept, slope, "HU"
+    voi = Dataset()
+    if burned or window[0] is None:
+        voi.WindowCenter, voi.WindowWidth = _window(pixels, slope, intercept)
+    else:
+        voi.WindowCenter, voi.WindowWidth = _first(window[0]), _first(window[1])
+
+    groups = Dataset()
+    groups.PlanePositionSequence = [pos]
+    groups.FrameContentSequence = [content]
+    groups.PixelValueTransformationSequence = [scaling]
+    groups.FrameVOILUTSequence = [voi]
+    return np.ascontiguousarray(pixels).tobytes(), groups
+
+# Copied from the first CT into an Enhanced CT object → value if absent or
+# empty there (None: left out; "": Type 2, present but empty; else Type 1)
+_ENHANCED_COPY = {
+    "SpecificCharacterSet": None, "StudyDescription": None, "BodyPartExamined": None,
+    "InstitutionName": None,
+    # Patient, General Study, General Series, Frame of Reference (Type 2)
+    "PatientName": "", "PatientID": "", "PatientBirthDate": "", "PatientSex": "",
+    "StudyDate": "", "StudyTime": "", "StudyID": "", "AccessionNumber": "",
+    "ReferringPhysicianName": "", "PatientPosition": "", "PositionReferenceIndicator": "",
+    # Enhanced Series, Enhanced General Equipment (Type 1)
+    "SeriesNumber": 1, "Manufacturer": "UNKNOWN", "ManufacturerModelName": "UNKNOWN",
+    "DeviceSerialNumber": "UNKNOWN", "SoftwareVersions": "UNKNOWN",
+}
+
+def _code(value: str, scheme: str, meaning: str) -> Dataset:
+    item = Dataset()
+    item.CodeValue, item.CodingSchemeDesignator, item.CodeMeaning = value, scheme, meaning
+    return item
+
+def _write_enhanced(series: CTSeries, view: PixelView, ident: dict, path: "str | None",
+                    progress=None, **pool):
+    """Write the kept slices as one Enhanced CT object (frames sorted along the normal).
+
+    Frames are prepared on the worker pool (progress per frame); every
+    slice must share one pixel type and matrix.
+    """
+    order = series.sorted_slices.tolist()
+    first = series.headers[order[0]]
+    if len({series.dtypes[i] for i in order}) > 1 or \
+       len({_slice_shape(series, i) for i in order}) > 1:
+        raise ValueError("Enhanced CT output needs one pixel type and matrix for all slices")
+
+    frames = pool_map(_enhanced_frame, range(len(order)),
+                      [view[i] for i in order], [i in view.written for i in order],
+                      [series.slopes[i] for i in order], [series.intercepts[i] for i in order],
+                      [(series.headers[i].get("WindowCenter"), series.headers[i].get("WindowWidth"))
+                       for i in order],
+                      [series.headers[i].ImagePositionPatient for i in order],
+                      progress=progress, **pool)
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = EnhancedCTImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = ident["SOPInstanceUID"]
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    for kw, default in _ENHANCED_COPY.items():
+        value = first.get(kw)
+        if value is None or value == "":
+            value = default
+        if value is not None:
+            setattr(ds, kw, value)
+    for kw, v in ident.items():
+        setattr(ds, kw, v)
+    now = datetime.now()
+    ds.SOPClassUID, ds.Modality = EnhancedCTImageStorage, "CT"
+    ds.ImageType = ["DERIVED", "PRIMARY", "AXIAL", "NONE"]
+    ds.ContentQualification = "RESEARCH"
+    ds.InstanceNumber = 1
+    ds.ContentDate, ds.ContentTime = now.strftime("%Y%m%d"), now.strftime("%H%M%S")
+    ds.PixelPresentation, ds.VolumetricProperties = "MONOCHROME", "VOLUME"
+    ds.VolumeBasedCalculationTechnique = "NONE"
+    ds.BurnedInAnnotation, ds.LossyImageCompression = "NO", "00"
+    ds.PresentationLUTShape = "IDENTITY"
+    ds.AcquisitionContextSequence = []
+
+    # Image pixel: one pixel type for all frames
+    ds.NumberOfFrames = len(order)
+    ds.Rows, ds.Columns = _slice_shape(series, order[0])
+    ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+    for kw in ("BitsAllocated", "BitsStored", "HighBit", "PixelRepresentation"):
+        setattr(ds, kw, first.get(kw))
+
+    # Geometry shared by every frame; position, scaling and window per frame
+    measures = Dataset()
+    measures.PixelSpacing = first.PixelSpacing
+    if "SliceThickness" in first:
+        measures.SliceThickness = first.SliceThickness
+    orientation = Dataset()
+    orientation.ImageOrientationPatient = first.ImageOrientationPatient
+    frame_type = Dataset()
+    frame_type.FrameType = ds.ImageType
+    for kw in ("PixelPresentation", "VolumetricProperties", "VolumeBasedCalculationTechnique"):
+        setattr(frame_type, kw, ds.get(kw))
+    anatomy = Dataset()
+    region = first.get("AnatomicRegionSequence")
+    anatomy.AnatomicRegionSequence = [region[0] if region else _code("38266002", "SCT", "Entire body")]
+    anatomy.FrameLaterality = "U"
+    event = Dataset()
+    event.IrradiationEventUID = first.get("IrradiationEventUID") or generate_uid()
+    shared = Dataset()
+    shared.PixelMeasuresSequence = [measures]
+    shared.PlaneOrientationSequence = [orientation]
+    shared.CTImageFrameTypeSequence = [frame_type]
+    shared.FrameAnatomySequence = [anatomy]
+    shared.IrradiationEventIdentificationSequence = [event]
+    ds.SharedFunctionalGroupsSequence = [shared]
+    ds.PerFrameFunctionalGroupsSequence = [groups for _, groups in frames]
+
+    # One dimension: position along the stack
+    org = Dataset()
+    org.DimensionOrganizationUID = generate_uid()
+    dim = Dataset()
+    dim.DimensionOrganizationUID = org.DimensionOrganizationUID
+    dim.DimensionIndexPointer = 0x00200032      # ImagePositionPatient
+    dim.FunctionalGroupPointer = 0x00209113     # PlanePositionSequence
+    ds.DimensionOrganizationSequence = [org]
+    ds.DimensionIndexSequence = [dim]
+
+    ds.PixelData = b"".join(data for data, _ in frames)
+    ds["PixelData"].VR = "OB" if ds.BitsAllocated <= 8 else "OW"
+    return _save(ds, path, file_format=True)
+
 # ------------------------------
 # Core burn-in (kept orientation-agnostic as in your working version)
 # ------------------------------
+def _pack_rows(mask: np.ndarray) -> tuple[int, np.ndarray]:
+    """Slice mask → row band (first row, packed bits of the rows from the
+    first to the last non-empty one); an empty mask packs to no bits."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not rows.size:
+        return 0, np.zeros(0, np.uint8)
+    return int(rows[0]), np.packbits(mask[rows[0]:rows[-1] + 1])
+
+def _unpack_rows(band: tuple[int, np.ndarray], shape: tuple[int,int]) -> tuple[slice, np.ndarray]:
+    """Row band → (its rows of the slice, bool mask of those rows)."""
+    r0, bits = band
+    W = shape[1]
+    h = bits.size * 8 // W
+    return slice(r0, r0 + h), np.unpackbits(bits, count=h * W).view(bool).reshape(h, W)
+
+def _union_rows(bands: list[tuple], shape: tuple[int,int]) -> np.ndarray:
+    """Full-slice bool union of row bands."""
+    mask = np.zeros(shape, dtype=bool)
+    for band in bands:
+        rows, m = _unpack_rows(band, shape)
+        mask[rows] |= m
+    return mask
+
+def _roi_mask(polys: list[np.ndarray], kind: str, shape: tuple[int,int]) -> tuple[int, np.ndarray]:
+    """Row-band mask (see _pack_rows) of one ROI on one slice: "outline" points or "fill"."""
+    H, W = shape
+    if kind == "fill":
+        # Even-odd (XOR) so inner holes remain air
+        return _pack_rows(rasterize_polygons(polys, shape))
+    mask = np.zeros(shape, dtype=bool)
+    x, y = np.concatenate(polys).T
+    inside = (x >= 0) & (x < W) & (y >= 0) & (y < H)
+    mask[y[inside], x[inside]] = True
+    return _pack_rows(mask)
+
+def stored_value(hu: float, slope: float, intercept: float, dtype,
+                 bits_stored: "int | None" = None) -> tuple[int, bool]:
+    """Target HU → a slice's stored pixel value, saturated to its dtype and
+    BitsStored range (a reader masking to HighBit sees no wrap) → (value, clipped)."""
+    value = round((hu - intercept) / slope)
+    info = np.iinfo(dtype)
+    lo, hi = int(info.min), int(info.max)
+    if bits_stored and int(bits_stored) < info.bits:
+        b = int(bits_stored)
+        lo, hi = (-(1 << (b - 1)), (1 << (b - 1)) - 1) if lo < 0 else (0, (1 << b) - 1)
+    stored = min(max(value, lo), hi)
+    return stored, stored != value
+
+def _burn_slice(raw: np.ndarray, masks: dict, ops: list[tuple]) -> np.ndarray:
+    """Apply (ROI index, stored value) ops to one stored-pixel slice in place, in order.
+
+    masks is the slice's LabelMap entry; each ROI's packed row band is
+    unpacked here only, so no full-frame label arrays outlive a slice.
+    """
+    for k, value in ops:
+        rows, m = _unpack_rows(masks[k], raw.shape)
+        raw[rows][m] = value
+    return raw
+
+def _write_slice(ds, raw, slope, intercept, ident: dict, path: "str | None",
+                 pixels: "np.ndarray | None" = None, rle: bool = False):
+    """Stamp burned pixels (stored values, original scaling) + identity, save one slice.
+
+    ds is left as read (it may be a header shared across tasks): the file
+    is written from a copy. raw=None (slice not burned): only the identity
+    changes, and the original pixel bytes are written with no encode.
+    Burned slices of a compressed source are written Explicit VR Little
+    Endian. path=None: return the encoded file bytes instead of saving.
+    rle: save the pixels RLE Lossless-compressed; an unburned slice uses
+    its decoded `pixels`, else decodes ds.
+    """
+    if rle and raw is None:
+        raw = pixels if pixels is not None else _decode(ds)
+        burned = False
+    else:
+        burned = raw is not None
+    ds = _derive(ds)
+    for kw, v in ident.items():
+        _replace(ds, kw, v)
+    if burned:
+        _replace(ds, "RescaleSlope", slope)
+        _replace(ds, "RescaleIntercept", intercept)
+        center, width = _window(raw, slope, intercept)
+        _replace(ds, "WindowCenter", center)
+        _replace(ds, "WindowWidth", width)
+    if rle:
+        return _save_rle(ds, raw, path)
+
+    if burned and ds.file_meta.TransferSyntaxUID.is_compressed:
+        _replace(ds.file_meta, "TransferSyntaxUID", ExplicitVRLittleEndian)
+    compressed = ds.file_meta.TransferSyntaxUID.is_compressed
+    value = raw.tobytes() if burned else ds["PixelData"].value
+    ds["PixelData"] = DataElement(0x7FE00010, "OB" if compressed or int(ds.BitsAllocated) <= 8 else "OW",
+                                  value, is_undefined_length=compressed)
+    return _save(ds, path)
+
+def _stream_slice(path: str, masks, ops: list[tuple], ident: dict, out_path: "str | None",
+                  rle: bool = False):
+    """Streaming mode: read, burn and write (or encode, see _write_slice) one slice.
+
+    Slices without ops are copied with the new identity (no decode).
+    """
+    if not ops:
+        return _write_slice(read_dataset(path), None, None, None, ident, out_path, rle=rle)
+    ds, raw, slope, intercept = _read_slice(path)
+    return _write_slice(ds, _burn_slice(np.require(raw, requirements="W"), masks, ops),
+                        slope, intercept, ident, out_path, rle=rle)
+
+class LabelMap:
+    """Per-slice ROI masks over a CTSeries (see build_label_map).
+
+    slices[i][k] is the mask where ROI names[k] applies on slice i (its
+    outline and/or fill) as a packed row band (see _pack_rows), for the
+    ROIs found there; present[i] has bit k set for each of them.
+    unmatched[name] counts an ROI's contours that matched no CT slice.
+    Masks stay packed (1 bit per pixel of the ROI's rows) and are
+    unpacked per slice while burning, in any number of ROIs.
+    """
+    def __init__(self, names: list[str], slices: dict, present: dict, unmatched: dict):
+        self.names     = names
+        self.slices    = slices
+        self.present   = present
+        self.unmatched = unmatched
+        # Label-stage metrics, filled in by build_label_map
+        self.stats     = {}
+
+    def bit(self, roi_name: str) -> int:
+        return 1 << self.names.index(roi_name.lower())
+
+def build_label_map(input_dir: str, settings_list: list[dict], series: CTSeries,
+                    workers: int = 1, processes: bool = False, progress=None,
+                    cancel=None, cache_dir: "str | None" = None,
+                    slice_tol: float = SLICE_TOL_MM, metrics: bool = False) -> LabelMap:
+    """Rasterize every ROI in settings_list once into a LabelMap for `series`.
+
+    Build it for all ROIs of a run and pass it to each run_roi_override
+    task; tasks then only look up their ROIs' bits. Contours come from the
+    series' RTSTRUCT (series.rtstruct, chosen by the loader). Each contour goes to
+    the CT slice nearest along the slice normal, if within `slice_tol` mm;
+    others are counted as unmatched. Outline/fill masks come from
+    `cache_dir` when cached. progress(stage, done, total) reports the ROI
+    slices rasterized as stage "mask". `metrics`: see load_ct_series.
+    """
+    # Stage time split: RTSTRUCT parsing, slice matching + densification,
+    # rasterization
+    t0 = _stage_start(metrics)
+    times = {"parse": 0.0, "densify": 0.0, "rasterize": 0.0}
+    cfg_map = {s["roi_name"].lower(): s for s in settings_list}
+    names = list(cfg_map)
+
+    rs_path = series.rtstruct
+    if not rs_path:
+        raise RuntimeError(f"Missing RTSTRUCT in {input_dir}")
+    rs = read_dataset(rs_path)
+    roi_nums = {r.ROIName.lower(): r.ROINumber for r in rs.StructureSetROISequence}
+    contours = {seq.ReferencedROINumber: seq for seq in rs.ROIContourSequence
+                if hasattr(seq, "ContourSequence")}
+    times["parse"] += time.perf_counter() - t0[0]
+
+    # Packed masks per (ROI, outline|fill) by slice: cached, else rasterized
+    mask_dir = rs_key = None
+    if cache_dir:
+        key = series.cache_key or series_cache_key(dict(zip(series.files, series.headers)))
+        mask_dir = os.path.join(_cache_entry(cache_dir, key), "masks")
+        rs_key = hashlib.sha1(json.dumps([_file_stamps([rs_path]), slice_tol]).encode()).hexdigest()[:16]
+    kinds_by_roi, masks, unmatched, jobs = {}, {}, {}, []
+    n_contours = n_points = n_cached = 0
+    for k, name in enumerate(names):
+        num = roi_nums.get(name)
+        if num not in contours:
+            continue
+
+        cfg = cfg_map[name]
+        kinds = [kd for kd, on in (("outline", cfg["contour"]), ("fill", cfg["fill"])) if on]
+        kinds_by_roi[k] = (num, kinds)
+        for kind in kinds:
+            cached = mask_dir and _load_masks(os.path.join(mask_dir, f"{rs_key}_{num}_{kind}.npz"))
+            if cached:
+                masks[num, kind], unmatched[num] = cached
+        missing = [kd for kd in kinds if (num, kd) not in masks]
+        if not missing:
+            n_cached += 1
+            continue
+
+        # Contours → slices by position along the slice normal
+        t = time.perf_counter()
+        contour_pts = [contour_points(ctr) for ctr in contours[num].ContourSequence]
+        times["parse"] += time.perf_counter() - t
+        t = time.perf_counter()
+        on_slice = series.find_slices([(pts @ series.normal).mean() for pts in contour_pts], slice_tol)
+        unmatched[num] = int((on_slice < 0).sum())
+        n_contours += len(contour_pts)
+
+        # Collect polygons by slice index
+        polys_by_slice: dict[int, list[np.ndarray]] = {}
+        for pts, i in zip(contour_pts, on_slice.tolist()):
+            if i < 0:
+                continue
+            pts = densify_contour(pts, max_mm=1.0)
+            n_points += len(pts)
+
+            # Simple patient→pixel mapping (no orientation handling by design)
+            poly = patient_to_pixel(pts, series.origins[i], series.spacings[i])
+            polys_by_slice.setdefault(i, []).append(poly)
+        times["densify"] += time.perf_counter() - t
+
+        for kind in missing:
+            masks[num, kind] = {}
+            jobs += [(num, kind, i, polys) for i, polys in polys_by_slice.items()]
+
+    if jobs:
+        t = time.perf_counter()
+        nums, kinds, slices, polys = zip(*jobs)
+        shapes = [_slice_shape(series, i) for i in slices]
+        bits = pool_map(_roi_mask, polys, kinds, shapes, workers=workers, processes=processes,
+                        progress=_stage(progress, "mask"), cancel=cancel)
+        for key, i, b in zip(zip(nums, kinds), slices, bits):
+            masks[key][i] = b
+        times["rasterize"] = time.perf_counter() - t
+        if mask_dir:
+            for key in sorted(set(zip(nums, kinds))):
+                _save_masks(os.path.join(mask_dir, f"{rs_key}_{key[0]}_{key[1]}.npz"),
+                            masks[key], unmatched[key[0]])
+            evict_cache(cache_dir, CACHE_BYTES, keep=os.path.dirname(mask_dir))
+
+    # Per slice: ROI index k ↔ names[k] → outline ∪ fill row band (non-empty only)
+    label_slices: dict[int, dict[int, tuple]] = {}
+    present: dict[int, int] = {}
+    for k, (num, kinds) in kinds_by_roi.items():
+        for kind in kinds:
+            for i, band in masks.pop((num, kind)).items():
+                if not band[1].size:
+                    continue
+                roi_masks = label_slices.setdefault(i, {})
+                if k in roi_masks:
+                    shape = _slice_shape(series, i)
+                    band = _pack_rows(_union_rows([roi_masks[k], band], shape))
+                roi_masks[k] = band
+                present[i] = present.get(i, 0) | (1 << k)
+    labels = LabelMap(names, label_slices, present,
+                      {names[k]: unmatched[num] for k, (num, _) in kinds_by_roi.items()})
+    labels.stats = _stage_stats(t0, rois=len(kinds_by_roi), rois_cached=n_cached,
+                                contours=n_contours, points=n_points,
+                                masks_rasterized=len(jobs), label_slices=len(label_slices),
+                                **{f"{k}_seconds": round(v, 4) for k, v in times.items()})
+    return labels
+
+def _slice_shape(series: CTSeries, i: int) -> tuple[int, int]:
+    return int(series.headers[i].Rows), int(series.headers[i].Columns)
+
+@_reading_inputs()
 def run_roi_override(input_dir: str,
                      output_dir: str,
-                     settings_list: list[dict]):
-    # Keep original pixel scaling + dtype per slice
-    orig_slopes, orig_intercepts, orig_dtypes = {}, {}, {}
+                     settings_list: list[dict],
+                     series: "CTSeries | None" = None,
+                     workers: int = 1,
+                     processes: bool = False,
+                     streaming: bool = False,
+                     progress=None,
+                     cancel=None,
+                     cache_dir: "str | None" = None,
+                     report: "dict | None" = None,
+                     labels: "LabelMap | None" = None,
+                     slice_tol: float = SLICE_TOL_MM,
+                     metrics: bool = False,
+                     archive: "str | zipfile.ZipFile | None" = None,
+                     output_format: str = "ct",
+                     store: "str | DicomStore | None" = None):
+    """Burn ROI overrides into a new CT series; returns the written file
+    paths (archive: entry names; store: SOP Instance UIDs).
+
+    Pass a preloaded `series` (load_ct_series, or load_ct_headers when
+    `streaming`) and `labels` (build_label_map for a superset of these
+    ROIs) to share one decode and rasterization across calls; neither is
+    modified. Where ROIs overlap, the one later in settings_list wins.
+    Per-slice work runs on `workers` threads (processes if `processes`)
+    with output identical to a serial run; `streaming` reads, burns and
+    writes one slice at a time.
+
+    Output goes to `output_dir`, into a ZIP (`archive`) or to a C-STORE
+    destination (`store`), encoded as `output_format` (OUTPUT_FORMATS).
+    `report` gets "clipped" and "unmatched_contours" (plus "metrics" and
+    "store" when used); `metrics` also writes <output_dir>.metrics.json.
+    progress(stage, done, total) reports "load", "mask", "burn" and
+    "write"; setting `cancel` drops the partial output and raises
+    BurnInCancelled. The README (Python API) has the details.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}, got {output_format!r}")
+    if archive is not None and store is not None:
+        raise ValueError("pass archive or store, not both")
+    if streaming and output_format == "enhanced":
+        raise ValueError("enhanced output holds every frame in memory; not with streaming")
+    started = datetime.now().isoformat(timespec="seconds")
+    t_run = time.perf_counter()
+    shared = {"load": series is not None, "labels": labels is not None}
 
     # Pick SeriesDescription from settings (Single mode: user entry)
     series_desc = settings_list[0].get("image_set_name",
                                        settings_list[0]["roi_name"])
 
-    # ROI config map: {roi_name_lower: {contour/fill/uniform}}
-    cfg_map = {
-        s["roi_name"].lower(): {
-            "contour": s["contour"],
-            "fill":    s["fill"],
-            "uniform": int(s["uniform"])
-        }
-        for s in settings_list
-    }
-
-    # Find CT + RS
-    files = glob.glob(os.path.join(input_dir, "*.dcm"))
-    ct_fs = [f for f in files if "CT" in os.path.basename(f).upper()]
-    rs_fs = [f for f in files if "RS" in os.path.basename(f).upper()]
-    if not ct_fs or not rs_fs:
-        raise RuntimeError(f"Missing CT or RTSTRUCT in {input_dir}")
-
-    # Load CTs → HU maps; assign new UIDs; index by z (string tag)
-    ct_arrays, ct_ds = {}, {}
+    # Decoded CTs (shared) or, when streaming, slice geometry only; fresh UIDs
+    pool = {"workers": workers, "processes": processes, "cancel": cancel}
+    if streaming:
+        if series is not None and series.pixels is not None:
+            raise ValueError("streaming reads slices from disk; pass a headers-only series")
+        if series is None:
+            series = load_ct_headers(input_dir, progress=progress, metrics=metrics, **pool)
+    elif series is None:
+        series = load_ct_series(input_dir, progress=progress, cache_dir=cache_dir,
+                                metrics=metrics, **pool)
+    if labels is None:
+        labels = build_label_map(input_dir, settings_list, series, progress=progress,
+                                 cache_dir=cache_dir, slice_tol=slice_tol, metrics=metrics, **pool)
     study_uid  = generate_uid()
     series_uid = generate_uid()
     frame_uid  = generate_uid()
 
-    for f in ct_fs:
-        ds = pydicom.dcmread(f)
-        raw = ds.pixel_array.copy()
-        slope = float(getattr(ds, "RescaleSlope", 1.0))
-        intercept = float(getattr(ds, "RescaleIntercept", 0.0))
-        orig_slopes[f], orig_intercepts[f], orig_dtypes[f] = slope, intercept, raw.dtype
-
-        hu = raw.astype(np.float32) * slope + intercept
-        z = f"{float(ds.ImagePositionPatient[2]):.2f}".replace("-0.00","0.00")
-        ct_arrays[z] = hu
-
-        # New identity for the output series
-        ds.StudyInstanceUID    = study_uid
-        ds.SeriesInstanceUID   = series_uid
-        ds.FrameOfReferenceUID = frame_uid
-        ds.SOPInstanceUID      = generate_uid()
-        ds.SeriesDescription   = series_desc
-        ct_ds[z] = ds
-
-    # Load RS + ROI numbers
-    rs = pydicom.dcmread(max(rs_fs, key=os.path.getmtime))
-    roi_nums = {r.ROIName.lower(): r.ROINumber for r in rs.StructureSetROISequence}
-    to_do = [roi_nums[n] for n in cfg_map if n in roi_nums]
-
-    # Point RS references at new CT series (not writing RS out, but consistent)
-    first_for = next(iter(ct_ds.values())).FrameOfReferenceUID
-    for ref in rs.ReferencedFrameOfReferenceSequence:
-        ref.FrameOfReferenceUID = first_for
-        for st in ref.RTReferencedStudySequence:
-            st.ReferencedSOPInstanceUID = study_uid
-            for se in st.RTReferencedSeriesSequence:
-                se.SeriesInstanceUID = series_uid
-
-    # Burn-in (per ROI → per slice); XOR fill keeps holes hollow
-    for seq in rs.ROIContourSequence:
-        if seq.ReferencedROINumber not in to_do or not hasattr(seq, "ContourSequence"):
-            continue
-
-        key = next(k for k,v in roi_nums.items() if v == seq.ReferencedROINumber)
-        cfg = cfg_map[key]
+    # This task's ROIs in priority order: (name, ROI index, target HU)
+    rois = [(s["roi_name"], labels.names.index(s["roi_name"].lower()), int(s["uniform"]))
+            for s in {s["roi_name"].lower(): s for s in settings_list}.values()]
+
+    # Burn ops per slice: (ROI index, target HU as this slice's stored
+    # value) for the ROIs present there; saturated values are reported
+    t_burn = _stage_start(metrics)
+    ops_by_slice: dict[int, list[tuple]] = {}
+    clipped: dict[str, dict] = {}
+    for i, present in labels.present.items():
+        ops = []
+        for name, k, uniform in rois:
+            if not present >> k & 1:
+                continue
+            value, clip = stored_value(uniform, series.slopes[i], series.intercepts[i],
+                                       series.dtypes[i], series.headers[i].get("BitsStored"))
+            if clip:
+                clipped.setdefault(name, {"hu": uniform, "stored": value, "slices": 0})["slices"] += 1
+            ops.append((k, value))
+        if ops:
+            ops_by_slice[i] = ops
+    if report is not None:
+        report["clipped"] = clipped
+        report["unmatched_contours"] = {
+            name: labels.unmatched[name.lower()] for name, _, _ in rois
+            if labels.unmatched.get(name.lower())}
+
+    # Output slices + identities (one per file); a duplicated z keeps the last slice
+    _check_cancel(cancel)
+    out = series.kept
+    rle = output_format == "rle"
+    if output_format == "enhanced":
+        names = ["CT.enhanced.dcm"]
+    else:
+        names = [f"CT.{series.z_keys[i]}.dcm" for i in out]
+    idents = [{"StudyInstanceUID":    study_uid,
+               "SeriesInstanceUID":   series_uid,
+               "FrameOfReferenceUID": frame_uid,
+               "SOPInstanceUID":      generate_uid(),
+               "SeriesDescription":   series_desc} for _ in names]
+    zf = sender = consume = None
+    if store is not None:
+        # Workers return encoded bytes; each is queued for C-STORE in slice order
+        sender = DicomStore(store) if isinstance(store, str) else store
+        paths, targets = [ident["SOPInstanceUID"] for ident in idents], [None] * len(names)
+        sent, t_send = dict(sender.stats), time.perf_counter()
+        def consume(k, data):
+            return sender.send(data)
+    elif archive is None:
+        created = not os.path.isdir(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        paths = targets = [os.path.join(output_dir, n) for n in names]
+    else:
+        # Workers return encoded bytes; entries are added here in slice order
+        zf = open_archive(archive) if isinstance(archive, str) else archive
+        folder = os.path.basename(os.path.normpath(output_dir))
+        paths, targets = [f"{folder}/{n}" for n in names], [None] * len(names)
+        def consume(k, data):
+            zf.writestr(paths[k], data)
+            return len(data)
+
+    try:
+        if streaming:
+            # Each slice is read, burned and written in the "write" stage
+            burn = _stage_stats(t_burn, slices=len(ops_by_slice))
+            t_write = _stage_start(metrics)
+            written = pool_map(functools.partial(_stream_slice, rle=rle),
+                               [series.files[i] for i in out],
+                               [labels.slices.get(i) if i in ops_by_slice else None for i in out],
+                               [ops_by_slice.get(i, []) for i in out],
+                               idents, targets,
+                               progress=_stage(progress, "write"), consume=consume, **pool)
+        else:
+            # Burn-in per slice (ROIs applied in order) into this task's pixel view
+            view = series.view()
+            touched = sorted(ops_by_slice)
+            burned = pool_map(_burn_slice,
+                              [view.writable(i) for i in touched],
+                              [labels.slices[i] for i in touched],
+                              [ops_by_slice[i] for i in touched],
+                              progress=_stage(progress, "burn"), **pool)
+            view.written.update(zip(touched, burned))
+            burn = _stage_stats(t_burn, slices=len(touched))
+
+            # Save CTs: burned slices get their new stored pixels (original
+            # scaling/dtype), the rest keep their original pixel bytes. Each
+            # file is written from a copy of its shared header with this
+            # task's identity (see _write_slice); the headers stay as read.
+            # Slice i ↔ series.files[i] is fixed at load time (no re-read here).
+            t_write = _stage_start(metrics)
+            if output_format == "enhanced":
+                data = _write_enhanced(series, view, idents[0], targets[0],
+                                       progress=_stage(progress, "write"), **pool)
+                written = [consume(0, data) if consume else data]
+            else:
+                written = pool_map(functools.partial(_write_slice, rle=rle),
+                                   [series.headers[i] for i in out],
+                                   [view.written.get(i) for i in out],
+                                   [series.slopes[i] for i in out],
+                                   [series.intercepts[i] for i in out],
+                                   idents, targets,
+                                   [view[i] if rle else None for i in out],
+                                   progress=_stage(progress, "write"), consume=consume, **pool)
+        if sender is not None:
+            sender.flush()
+            sent = sender.throughput(sent, t_send)
+            if report is not None:
+                report["store"] = sent
+    except BurnInCancelled:
+        # Drop partial output (and the folder or archive, if this run created it)
+        if zf is None and sender is None:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            if created and not os.listdir(output_dir):
+                os.rmdir(output_dir)
+        elif zf is not None and zf is not archive:
+            zf.close()
+            os.remove(archive)
+        raise
+    finally:
+        if zf is not None and zf is not archive:
+            zf.close()
+        if sender is not None and sender is not store:
+            sender.close()
+
+    if metrics:
+        write = _stage_stats(t_write, files_written=len(paths), bytes_written=sum(
+            written if consume is not None else map(os.path.getsize, paths)))
+        # Pixels set by this task's ROIs (union of their masks), counted
+        # after the timed stages
+        burn["pixels"] = sum(
+            int(np.count_nonzero(_union_rows([labels.slices[i][k] for k, _ in ops],
+                                             _slice_shape(series, i))))
+            for i, ops in ops_by_slice.items())
+        stages = {"load":   {**series.stats, "shared": shared["load"]},
+                  "labels": {**labels.stats, "shared": shared["labels"]},
+                  "burn":   burn,
+                  "write":  write}
+        peaks = [st["peak_rss_mb"] for st in stages.values() if st.get("peak_rss_mb") is not None]
+        log = {"output": output_dir, "rois": [name for name, _, _ in rois],
+               "streaming": streaming, "workers": workers, "processes": processes,
+               "started": started, "seconds": round(time.perf_counter() - t_run, 4),
+               "peak_rss_mb": max(peaks, default=None),
+               # Peaks are of the whole process: concurrent runs and other
+               # threads in it count too, and reset each other's stage peaks
+               "peak_rss_scope": "process", "stages": stages}
+        if sender is not None:
+            log["store"] = sent
+        log_path = os.path.normpath(output_dir) + ".metrics.json"
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        with open(log_path, "w", encoding="utf-8") as fh:
+            json.dump(log, fh, indent=2)
+        if report is not None:
+            report["metrics"] = log
+    return paths
+
+def metrics_summary(log: dict) -> str:
+    """One-line summary of a run_roi_override metrics log (GUI status)."""
+    st = log["stages"]
+    text = (f"{os.path.basename(log['output'])}: {st['write']['files_written']} slices, "
+            f"{st['burn']['pixels']:,} px in {log['seconds']:.1f} s "
+            f"(load {st['load']['seconds']:.1f}, ROIs {st['labels']['seconds']:.1f}, "
+            f"burn {st['burn']['seconds']:.1f}, write {st['write']['seconds']:.1f} s; "
+            f"{st['write']['bytes_written'] / (1 << 20):.0f} MB)")
+    if log["peak_rss_mb"] is not None:
+        text += f", peak {log['peak_rss_mb']:.0f} MB RSS"
+    if "store" in log:
+        sent = log["store"]
+        text += (f"; C-STORE {sent['files']} to {sent['destination']} at "
+                 f"{sent['mb_per_s']:.1f} MB/s ({sent['retries']} retries)")
+    return text
+
+def open_archive(path: str) -> zipfile.ZipFile:
+    """New ZIP for run_roi_override(archive=...) output (ZIP_COMPRESSION, ZIP64)."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return zipfile.ZipFile(path, "w", ZIP_COMPRESSION, allowZip64=True)
+
+def plan_archives(output: str, tasks: list[tuple[list[dict], str]], parent: str) -> list:
+    """archive= for each task (see run_roi_override) in an OUTPUT_MODES mode.
+
+    "zip" opens one shared `<parent>/<parent name>.zip` (the caller closes
+    it); "zip-per-set" gives each task `<its folder>.zip`.
+    """
+    if output == "zip":
+        name = os.path.basename(os.path.normpath(parent)) + ".zip"
+        return [open_archive(os.path.join(parent, name))] * len(tasks)
+    if output == "zip-per-set":
+        return [os.path.normpath(out) + ".zip" for _, out in tasks]
+    return [None] * len(tasks)
+
+def plan_tasks(settings: list[dict], mode: str, parent: str) -> list[tuple[list[dict], str]]:
+    """(settings, output folder) per run: one Combined_* or one per ROI."""
+    if mode == "combine":
+        safe = "_".join(s["roi_name"].replace(" ", "_") for s in settings)
+        return [(settings, os.path.join(parent, f"Combined_{safe}"))]
+    return [([s], os.path.join(parent, s["image_set_name"])) for s in settings]
 
-        # Collect polygons by slice z
-        polys_by_z: dict[str, list[list[tuple[int,int]]]] = {}
-        for ctr in seq.ContourSequence:
-            pts = np.array(ctr.ContourData).reshape(-1,3)
-            pts = densify_contour(pts, max_mm=1.0)
-            z = f"{pts[0,2]:.2f}".replace("-0.00","0.00")
+# ------------------------------
+# DICOM network export (C-STORE)
+# ------------------------------
+# Proposed per output SOP class, one presentation context each: the
+# uncompressed syntaxes (converted between as needed), RLE Lossless output
+# and the lossless syntaxes untouched source slices may keep
+_STORE_SYNTAXES = ([ExplicitVRLittleEndian, ImplicitVRLittleEndian], RLELossless,
+                   JPEGLosslessSV1, JPEGLSLossless, JPEG2000Lossless)
+
+class StoreError(Exception):
+    """Raised when instances could not be stored after all retries."""
+
+def parse_store_dest(dest: str) -> tuple[str, str, int]:
+    """Split "AET@host:port" into (called AE title, host, port)."""
+    m = re.fullmatch(r"([^@]{1,16})@(.+):(\d+)", dest.strip())
+    if not m:
+        raise ValueError(f"C-STORE destination must be AET@host:port, got {dest!r}")
+    return m[1], m[2], int(m[3])
+
+class DicomStore:
+    """C-STORE destination for run_roi_override(store=...).
+
+    Up to `concurrency` associations are opened on first use and reused
+    for every instance sent, across series, until close(). send() queues
+    one encoded file (blocking while 2 × concurrency are queued). A store
+    that fails (no association, association lost, no response or a
+    failure status) is retried up to `retries` times, with backoff, on an
+    idle or fresh association; flush() waits for the queue and raises
+    StoreError for instances that never succeeded.
+    """
+
+    def __init__(self, dest: str, concurrency: int = STORE_CONCURRENCY,
+                 retries: int = STORE_RETRIES, calling_ae: str = STORE_AE_TITLE,
+                 timeout: float = 30.0, retry_delay: float = 0.5):
+        if pynetdicom is None:
+            raise RuntimeError("C-STORE export needs pynetdicom (pip install pynetdicom)")
+        self.dest = dest
+        self.called_ae, self.host, self.port = parse_store_dest(dest)
+        self.retries, self.retry_delay = retries, retry_delay
+        self.ae = pynetdicom.AE(ae_title=calling_ae)
+        self.ae.acse_timeout = self.ae.dimse_timeout = self.ae.network_timeout = timeout
+        for sop in (CTImageStorage, EnhancedCTImageStorage):
+            for syntax in _STORE_SYNTAXES:
+                self.ae.add_requested_context(sop, syntax)
+        self.stats = {"files": 0, "bytes": 0, "retries": 0, "failed": 0, "associations": 0}
+        self._lock = threading.Lock()
+        self._idle = queue.SimpleQueue()            # established associations not in use
+        self._ex = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self._slots = threading.BoundedSemaphore(2 * max(1, concurrency))
+        self._pending = []
+
+    def _count(self, **deltas):
+        with self._lock:
+            for k, v in deltas.items():
+                self.stats[k] += v
+
+    def _store(self, ds) -> str:
+        """One C-STORE attempt on an idle (or new) association → error text, "" if stored."""
+        try:
+            assoc = self._idle.get_nowait()
+        except queue.Empty:
+            assoc = self.ae.associate(self.host, self.port, ae_title=self.called_ae)
+            if not assoc.is_established:
+                return f"no association with {self.dest}"
+            self._count(associations=1)
+        try:
+            status = assoc.send_c_store(ds)
+        except ValueError:
+            self._idle.put(assoc)
+            raise                                   # no accepted context: retrying won't help
+        except (RuntimeError, OSError) as e:
+            assoc.abort()
+            return f"{type(e).__name__}: {e}"
+        if not assoc.is_established:
+            return "association lost"
+        self._idle.put(assoc)
+        code = status.get("Status")
+        if code is None:
+            return "no response"
+        if code in (0x0000, 0x0001) or 0xB000 <= code <= 0xBFFF:
+            return ""                               # success or warning
+        return f"status 0x{code:04X}"
+
+    def _send(self, data: bytes) -> int:
+        """Store one encoded file with retries (pool thread)."""
+        ds = pydicom.dcmread(io.BytesIO(data))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count(retries=1)
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                error = self._store(ds)
+            except ValueError as e:
+                self._count(failed=1)
+                raise StoreError(f"{ds.SOPInstanceUID}: {e}") from e
+            if not error:
+                self._count(files=1, bytes=len(data))
+                return len(data)
+        self._count(failed=1)
+        raise StoreError(f"{ds.SOPInstanceUID}: {error}")
+
+    def send(self, data: bytes) -> int:
+        """Queue one encoded DICOM file for C-STORE → its size."""
+        self._slots.acquire()
+        fut = self._ex.submit(self._send, data)
+        fut.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(fut)
+        return len(data)
+
+    def flush(self):
+        """Wait for every queued instance; StoreError if any failed."""
+        pending, self._pending = self._pending, []
+        errors = [e for e in (fut.exception() for fut in pending) if e is not None]
+        if errors:
+            raise StoreError(f"{len(errors)} of {len(pending)} instance(s) not stored on "
+                             f"{self.dest}; first: {errors[0]}")
+
+    def throughput(self, since: dict, t0: float) -> dict:
+        """Counts since a `stats` snapshot taken at perf_counter() t0, with rates."""
+        secs = max(time.perf_counter() - t0, 1e-9)
+        d = {k: v - since.get(k, 0) for k, v in self.stats.items()}
+        return {"destination": self.dest, **d, "seconds": round(secs, 4),
+                "files_per_s": round(d["files"] / secs, 1),
+                "mb_per_s": round(d["bytes"] / (1 << 20) / secs, 2)}
+
+    def close(self):
+        """Finish queued sends, then release every association."""
+        self._ex.shutdown(wait=True)
+        while True:
+            try:
+                self._idle.get_nowait().release()
+            except queue.Empty:
+                break
 
-            ds = ct_ds.get(z); hu = ct_arrays.get(z)
-            if ds is None or hu is None:
+# ------------------------------
+# Headless batch (CLI)
+# ------------------------------
+def load_spec(path: str) -> dict:
+    """Read + validate a batch override spec (JSON).
+
+    {"mode": "combine" | "separate",
+     "image_set_name": "...",                       # combine; default first ROI
+     "rois": [{"roi": "Couch.*", "regex": true,     # name or regex (case-insensitive)
+               "contour": false, "fill": true,
+               "hu": 0,
+               "image_set_name": "..."}]}           # separate; default ROI name
+    """
+    with open(path, encoding="utf-8") as fh:
+        spec = json.load(fh)
+    if spec.get("mode", "combine") not in ("combine", "separate"):
+        raise ValueError(f"{path}: mode must be 'combine' or 'separate'")
+    if not spec.get("rois"):
+        raise ValueError(f"{path}: 'rois' must list at least one ROI")
+    for r in spec["rois"]:
+        if "roi" not in r or "hu" not in r:
+            raise ValueError(f"{path}: every ROI entry needs 'roi' and 'hu'")
+        if not (r.get("contour") or r.get("fill")):
+            raise ValueError(f"{path}: ROI '{r['roi']}' needs contour or fill")
+        int(r["hu"])
+        if r.get("regex"):
+            re.compile(r["roi"])
+    return spec
+
+def spec_settings(spec: dict, roi_names: list[str]) -> tuple[list[dict], list[str]]:
+    """Expand a spec against one RTSTRUCT's ROI names → (settings, unmatched)."""
+    mode = spec.get("mode", "combine")
+    settings, unmatched, taken = [], [], set()
+    for r in spec["rois"]:
+        if r.get("regex"):
+            pat = re.compile(r["roi"], re.IGNORECASE)
+            names = [n for n in roi_names if pat.fullmatch(n)]
+        else:
+            names = [n for n in roi_names if n.lower() == r["roi"].lower()]
+        if not names:
+            unmatched.append(r["roi"])
+        for n in names:
+            if n.lower() in taken:
                 continue
-
-            # Simple patient→pixel mapping (no orientation handling by design)
-            poly = [(
-                int((x - ds.ImagePositionPatient[0]) / ds.PixelSpacing[0]),
-                int((y - ds.ImagePositionPatient[1]) / ds.PixelSpacing[1])
-            ) for x,y,_ in pts]
-            polys_by_z.setdefault(z, []).append(poly)
-
-        # Apply for each slice
-        for z, polys in polys_by_z.items():
-            hu = ct_arrays[z]
-            H, W = hu.shape
-
-            # Contour-only = set outline points
-            if cfg["contour"]:
-                for poly in polys:
-                    for x, y in poly:
-                        if 0 <= x < W and 0 <= y < H:
-                            hu[y, x] = cfg["uniform"]
-
-            # Fill with even-odd (XOR) so inner holes remain air
-            if cfg["fill"]:
-                mask = Image.new("1", (W, H), 0)
-                for poly in polys:
-                    tmp = Image.new("1", (W, H), 0)
-                    ImageDraw.Draw(tmp).polygon(poly, outline=1, fill=1)
-                    mask = ImageChops.logical_xor(mask, tmp)
-                hu[np.array(mask, dtype=bool)] = cfg["uniform"]
-
-    # Save CTs (HU → raw), keep original scaling/dtype
-    os.makedirs(output_dir, exist_ok=True)
-    for f in ct_fs:
-        ds_src = pydicom.dcmread(f)
-        z = f"{float(ds_src.ImagePositionPatient[2]):.2f}".replace("-0.00","0.00")
-
-        ds = ct_ds[z]
-        hu = ct_arrays[z]
-        slope = orig_slopes[f]; intercept = orig_intercepts[f]; dtype = orig_dtypes[f]
-
-        raw_new = np.round((hu - intercept) / slope).astype(dtype)
-        raw_new = np.clip(raw_new, np.iinfo(dtype).min, np.iinfo(dtype).max)
-        ds.PixelData = raw_new.tobytes()
-
-        ds.RescaleSlope     = slope
-        ds.RescaleIntercept = intercept
-        ds.WindowCenter     = int((hu.max() + hu.min()) / 2)
-        ds.WindowWidth      = int(max(hu.max() - hu.min(), 1))
-
-        ds.save_as(os.path.join(output_dir, f"CT.{z}.dcm"))
+            taken.add(n.lower())
+            settings.append({
+                "roi_name":       n,
+                "contour":        bool(r.get("contour")),
+                "fill":           bool(r.get("fill")),
+                "uniform":        int(r["hu"]),
+                "image_set_name": r.get("image_set_name") or n,
+            })
+    if mode == "combine" and settings:
+        name = spec.get("image_set_name") or settings[0]["roi_name"]
+        for s in settings:
+            s["image_set_name"] = name
+    return settings, unmatched
+
+@_reading_inputs()
+def find_patients(root: str) -> list[str]:
+    """Inputs under root holding CT + RTSTRUCT files: the innermost folders
+    whose tree holds both (patA/CT/*.dcm + patA/RS/*.dcm → patA), and ZIP
+    archives that do. Folders and archives holding a patient are not one.
+    """
+    found = []
+
+    def kinds_under(path: str) -> "set | None":
+        """DICOM kinds in a folder tree or ZIP; None once it holds a patient."""
+        kinds, inner = set(), False
+        if os.path.isfile(path):
+            kinds = {kind for kind, hit in zip(("CT", "RTSTRUCT"), scan_folder(path)) if hit}
+        else:
+            for e in sorted(os.scandir(path), key=lambda e: e.name):
+                if e.is_dir(follow_symlinks=False):
+                    if e.name.startswith(OUTPUT_PREFIX):
+                        continue
+                    sub = kinds_under(e.path)
+                elif e.name.lower().endswith(".zip"):
+                    sub = kinds_under(e.path)
+                else:
+                    sub = {dicom_kind(peek_header(e.path))}
+                if sub is None:
+                    inner = True
+                else:
+                    kinds |= sub
+        if inner:
+            return None
+        if {"CT", "RTSTRUCT"} <= kinds:
+            found.append(path)
+            return None
+        return kinds
+
+    kinds_under(root)
+    return sorted(found)
+
+@_reading_inputs()
+def process_patient(folder: str, spec: dict, out_dir: str, workers: int = 1,
+                    streaming: bool = False, cache_dir: "str | None" = None,
+                    slice_tol: float = SLICE_TOL_MM, metrics: bool = False,
+                    output: str = "folder", output_format: str = "ct",
+                    store: "dict | None" = None) -> dict:
+    """Run one patient folder; never raises. Writes/returns its manifest.
+
+    `store` (DicomStore keyword arguments) sends every series by C-STORE
+    over one association pool per patient instead of writing it.
+    """
+    t0 = time.monotonic()
+    manifest = {"input": folder, "output": out_dir, "status": "ok",
+                "started": datetime.now().isoformat(timespec="seconds"),
+                "series": [], "unmatched": [], "slices": 0}
+    try:
+        # One header scan per patient, shared by the loaders below
+        inputs = select_input(folder)
+        rs = inputs[2]
+        if rs is None:
+            raise RuntimeError(f"Missing RTSTRUCT in {folder}")
+        settings, manifest["unmatched"] = spec_settings(
+            spec, [r.ROIName for r in rs.StructureSetROISequence])
+        if not settings:
+            manifest["status"] = "skipped"
+            manifest["error"] = "no spec ROI found in RTSTRUCT"
+        else:
+            if streaming:
+                series = load_ct_headers(folder, workers, metrics=metrics, inputs=inputs)
+            else:
+                series = load_ct_series(folder, workers, cache_dir=cache_dir, metrics=metrics,
+                                        inputs=inputs)
+            labels = build_label_map(folder, settings, series, workers, cache_dir=cache_dir,
+                                     slice_tol=slice_tol, metrics=metrics)
+            tasks = plan_tasks(settings, spec.get("mode", "combine"), out_dir)
+            archives = plan_archives(output, tasks, out_dir)
+            sender = None
+            try:
+                if store:
+                    sender = DicomStore(**store)
+                for (cfg, out), archive in zip(tasks, archives):
+                    report = {}
+                    written = run_roi_override(folder, out, cfg, series=series, workers=workers,
+                                               streaming=streaming, cache_dir=cache_dir,
+                                               report=report, labels=labels, metrics=metrics,
+                                               archive=archive, output_format=output_format,
+                                               store=sender)
+                    entry = {"output": out,
+                             "rois": [c["roi_name"] for c in cfg],
+                             "files": len(written),
+                             "clipped": report["clipped"],
+                             "unmatched_contours": report["unmatched_contours"]}
+                    if archive is not None:
+                        entry["archive"] = getattr(archive, "filename", archive)
+                    if sender is not None:
+                        entry["store"] = report["store"]
+                    if metrics:
+                        entry["metrics"] = os.path.normpath(out) + ".metrics.json"
+                    manifest["series"].append(entry)
+                    manifest["slices"] += len(series.kept)
+            finally:
+                if output == "zip":
+                    archives[0].close()
+                if sender is not None:
+                    sender.close()
+    except Exception as e:
+        manifest["status"] = "error"
+        manifest["error"] = f"{type(e).__name__}: {e}"
+
+    manifest["seconds"] = round(time.monotonic() - t0, 3)
+    manifest["slices_per_s"] = round(manifest["slices"] / max(manifest["seconds"], 1e-9), 1)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2)
+    return manifest
+
+@_reading_inputs()
+def run_batch(root: str, spec: dict, out_root: str, jobs: int = 1, workers: int = 1,
+              streaming: bool = False, cache_dir: "str | None" = None,
+              slice_tol: float = SLICE_TOL_MM, metrics: bool = False, output: str = "folder",
+              output_format: str = "ct", store: "dict | None" = None, log=print) -> dict:
+    """Process every patient folder under root, `jobs` patients at a time."""
+    patients = find_patients(root)
+    # Output mirrors the input tree (an archive p.zip → folder p)
+    outs = [os.path.normpath(os.path.join(out_root, re.sub(r"\.zip$", "", os.path.relpath(p, root),
+                                                           flags=re.IGNORECASE)))
+            for p in patients]
+    log(f"{len(patients)} patient folder(s) under {root}")
+
+    t0 = time.monotonic()
+    def progress(done, total):
+        log(f"[{done}/{total}] {os.path.relpath(patients[done - 1], root)}")
+    manifests = pool_map(process_patient, patients, [spec] * len(patients), outs,
+                         [workers] * len(patients), [streaming] * len(patients),
+                         [cache_dir] * len(patients), [slice_tol] * len(patients),
+                         [metrics] * len(patients), [output] * len(patients),
+                         [output_format] * len(patients), [store] * len(patients),
+                         workers=jobs, processes=jobs > 1, progress=progress)
+    secs = time.monotonic() - t0
+
+    slices = sum(m["slices"] for m in manifests)
+    summary = {"root": root, "output": out_root, "patients": len(manifests),
+               "ok": sum(m["status"] == "ok" for m in manifests),
+               "skipped": sum(m["status"] == "skipped" for m in manifests),
+               "errors": sum(m["status"] == "error" for m in manifests),
+               "slices": slices, "seconds": round(secs, 3),
+               "slices_per_s": round(slices / max(secs, 1e-9), 1),
+               "manifests": [os.path.join(m["output"], "manifest.json") for m in manifests]}
+    if store:
+        sent = [e["store"] for m in manifests for e in m["series"] if "store" in e]
+        send_s = sum(e["seconds"] for e in sent)
+        summary["store"] = {"destination": store["dest"],
+                            "files": sum(e["files"] for e in sent),
+                            "bytes": sum(e["bytes"] for e in sent),
+                            "retries": sum(e["retries"] for e in sent),
+                            "seconds": round(send_s, 3)}
+        summary["store"]["mb_per_s"] = round(summary["store"]["bytes"] / (1 << 20)
+                                             / max(send_s, 1e-9), 2)
+    os.makedirs(out_root, exist_ok=True)
+    with open(os.path.join(out_root, "batch_summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, indent=2)
+    for m in manifests:
+        if m["status"] != "ok":
+            log(f"  {m['status']}: {m['input']}: {m.get('error', '')}")
+    log(f"{summary['ok']}/{summary['patients']} ok, {slices} slices in {secs:.1f} s "
+        f"({summary['slices_per_s']} slices/s)")
+    if store:
+        sent = summary["store"]
+        log(f"C-STORE {sent['destination']}: {sent['files']} instance(s), "
+            f"{sent['mb_per_s']} MB/s while sending, {sent['retries']} retries")
+    return summary
+
+def main(argv: "list[str] | None" = None):
+    """No arguments: GUI. Otherwise: headless batch over a root folder."""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        ctk.set_appearance_mode("dark")
+        ctk.set_default_color_theme("blue")
+        ROIApp().mainloop()
+        return 0
+
+    ap = argparse.ArgumentParser(description="Burn ROI HU overrides for every patient folder under ROOT.")
+    ap.add_argument("root", help="folder containing patient folders (CT + RTSTRUCT *.dcm)")
+    ap.add_argument("--spec", required=True, help="JSON override spec (see load_spec)")
+    ap.add_argument("--out", required=True, help="output root (mirrors the patient folder tree)")
+    ap.add_argument("--jobs", type=int, default=1, help="patients processed concurrently (processes)")
+    ap.add_argument("--workers", type=int, default=1, help="slice threads per patient")
+    ap.add_argument("--streaming", action="store_true", help="bounded-memory streaming burn-in")
+    ap.add_argument("--cache", metavar="DIR", default=CACHE_DIR,
+                    help="cache decoded CT volumes + ROI masks here for reruns")
+    ap.add_argument("--slice-tol", type=float, default=SLICE_TOL_MM, metavar="MM",
+                    help=f"max contour-to-slice distance along the normal (default {SLICE_TOL_MM})")
+    ap.add_argument("--metrics", action="store_true",
+                    help="write per-stage timing/memory/count logs beside each output series")
+    ap.add_argument("--output", choices=OUTPUT_MODES, default="folder",
+                    help="series folders, one ZIP per patient, or one ZIP per image set")
+    ap.add_argument("--format", choices=OUTPUT_FORMATS, default="ct",
+                    help="CT slices, RLE Lossless CT slices, or one Enhanced CT multi-frame per series")
+    ap.add_argument("--store", metavar="AET@HOST:PORT",
+                    help="send each series by DICOM C-STORE instead of writing it")
+    ap.add_argument("--store-concurrency", type=int, default=STORE_CONCURRENCY, metavar="N",
+                    help=f"associations per patient (default {STORE_CONCURRENCY})")
+    ap.add_argument("--store-retries", type=int, default=STORE_RETRIES, metavar="N",
+                    help=f"retries per instance (default {STORE_RETRIES})")
+    args = ap.parse_args(argv)
+    store = None
+    if args.store:
+        if args.output != "folder":
+            ap.error("--store replaces --output")
+        try:
+            parse_store_dest(args.store)
+        except ValueError as e:
+            ap.error(str(e))
+        store = {"dest": args.store, "concurrency": args.store_concurrency,
+                 "retries": args.store_retries}
+
+    summary = run_batch(args.root, load_spec(args.spec), args.out,
+                        jobs=args.jobs, workers=args.workers, streaming=args.streaming,
+                        cache_dir=args.cache, slice_tol=args.slice_tol, metrics=args.metrics,
+                        output=args.output, output_format=args.format, store=store)
+    return 0 if summary["errors"] == 0 else 1
 
 # ------------------------------
 # GUI
 # ------------------------------
+# Output menu entries → OUTPUT_MODES, or "store" (C-STORE to a destination)
+OUTPUT_LABELS = {"Output: Folders": "folder", "Output: One ZIP": "zip",
+                 "Output: ZIP per ImageSet": "zip-per-set", "Output: DICOM C-STORE": "store"}
+# Format menu entries → OUTPUT_FORMATS
+FORMAT_LABELS = {"Format: CT slices": "ct", "Format: RLE Lossless": "rle",
+                 "Format: Enhanced CT": "enhanced"}
+
 class ROIApp(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -206,8 +2052,15 @@ class ROIApp(ctk.CTk):
         left.grid_columnconfigure(0, weight=1)
         left.grid_rowconfigure(2, weight=1)
 
-        ctk.CTkButton(left, text="Select DICOM Folder", height=35,
-                      command=self.pick_folder).grid(row=0, column=0, pady=(20,5))
+        pick = ctk.CTkFrame(left, fg_color="transparent")
+        pick.grid(row=0, column=0, pady=(20,5))
+        # Input pickers (disabled while a burn-in runs)
+        self.pickers = [
+            ctk.CTkButton(pick, text="Select DICOM Folder", height=35, command=self.pick_folder),
+            ctk.CTkButton(pick, text="Select ZIP", height=35,
+                          command=lambda: self.pick_folder(archive=True))]
+        self.pickers[0].grid(row=0, column=0, padx=(0,5))
+        self.pickers[1].grid(row=0, column=1, padx=(5,0))
         ctk.CTkLabel(left, text="Available ROIs").grid(row=1, column=0, pady=(5,5))
 
         self.listbox = CTkListbox(left, multiple_selection=True)
@@ -256,12 +2109,30 @@ class ROIApp(ctk.CTk):
         ctk.CTkRadioButton(rb, text="Single ImageSet",   variable=self.mode, value="combine").grid(row=0, column=0, sticky="e", padx=(0,20))
         ctk.CTkRadioButton(rb, text="Separate ImageSets",variable=self.mode, value="separate").grid(row=0, column=1, sticky="w", padx=(20,0))
         self.mode.trace_add("write", lambda *a: self._on_mode_change())
-
-        ctk.CTkButton(right, text="Burn In ROIs", height=35, command=self.burn_in)\
-            .grid(row=7, column=0, columnspan=7, pady=(5,5))
+        self.output = ctk.CTkOptionMenu(rb, values=list(OUTPUT_LABELS), width=170)
+        self.output.set(next(iter(OUTPUT_LABELS)))
+        self.output.grid(row=1, column=0, sticky="e", padx=(0,20), pady=(8,0))
+        self.format = ctk.CTkOptionMenu(rb, values=list(FORMAT_LABELS), width=170)
+        self.format.set(next(iter(FORMAT_LABELS)))
+        self.format.grid(row=1, column=1, sticky="w", padx=(20,0), pady=(8,0))
+
+        actions = ctk.CTkFrame(right, fg_color="transparent")
+        actions.grid(row=7, column=0, columnspan=7, pady=(5,5))
+        self.burn_btn = ctk.CTkButton(actions, text="Burn In ROIs", height=35, command=self.burn_in)
+        self.burn_btn.grid(row=0, column=0, padx=(0,10))
+        self.cancel_btn = ctk.CTkButton(actions, text="Cancel", height=35, fg_color="red",
+                                        state="disabled", command=self._cancel_burn)
+        self.cancel_btn.grid(row=0, column=1, padx=(10,0))
 
         self.progress = ctk.CTkProgressBar(right)
-        self.progress.grid(row=8, column=0, columnspan=7, sticky="ew", padx=5, pady=(0,20))
+        self.progress.grid(row=8, column=0, columnspan=7, sticky="ew", padx=5, pady=(0,5))
+        self.progress.set(0)
+        self.eta = ctk.CTkLabel(right, text="", anchor="center")
+        self.eta.grid(row=9, column=0, columnspan=7, sticky="ew", pady=(0,15))
+
+        # Background burn-in state (see burn_in/_poll_burn)
+        self._cancel = None
+        self._job = None
 
         # HU validator
         self._vc = (self.register(self._validate_hu), '%P')
@@ -273,22 +2144,25 @@ class ROIApp(ctk.CTk):
         """Allow blank/'-'/integer (for manual HU)."""
         return (P == "" or P == "-" or P.isdigit() or (P.startswith("-") and P[1:].isdigit()))
 
-    def pick_folder(self):
-        """Choose folder, verify RS↔CT linkage, list ROIs."""
-        fd = filedialog.askdirectory()
+    @_reading_inputs()
+    def pick_folder(self, archive: bool = False):
+        """Choose folder (subfolders included) or ZIP, verify RS↔CT linkage, list ROIs."""
+        fd = (filedialog.askopenfilename(filetypes=[("ZIP archives", "*.zip")]) if archive
+              else filedialog.askdirectory())
         if not fd: return
         self.folder = fd
 
-        files = glob.glob(os.path.join(fd, "*.dcm"))
-        ct_fs = [f for f in files if "CT" in os.path.basename(f).upper()]
-        rs_fs = [f for f in files if "RS" in os.path.basename(f).upper()]
-        if not ct_fs:
-            return messagebox.showerror("Error", "Folder must contain at least one CT (.dcm) file.")
-        if len(rs_fs) != 1:
-            return messagebox.showerror("Error", "Folder must contain exactly one RTSTRUCT (.dcm) file.")
-
-        rsd = pydicom.dcmread(rs_fs[0])
-        first_ct = pydicom.dcmread(ct_fs[0])
+        cts, rss = scan_folder(fd)
+        if not cts:
+            return messagebox.showerror("Error", "Folder must contain at least one CT file.")
+        if len(rss) != 1:
+            return messagebox.showerror("Error", "Folder must contain exactly one RTSTRUCT file.")
+        rsd = read_structure_set(next(iter(rss)))
+        try:
+            cts = referenced_series(cts, rsd)
+        except RuntimeError as e:
+            return messagebox.showerror("Error", str(e))
+        first_ct = next(iter(cts.values()))
 
         # RS must reference the same Study as CT
         ct_study_uid = getattr(first_ct, "StudyInstanceUID", None)
@@ -307,7 +2181,7 @@ class ROIApp(ctk.CTk):
         date = getattr(first_ct, "StudyDate", "")
         if len(date)==8: date = f"{date[:4]}-{date[4:6]}-{date[6:8]}"
         self.info_combined.configure(text=f"MRN: {pid}    Patient: {pname}    Study Date: {date}")
-        self.summary.configure(text=f"Loaded {len(ct_fs)} CT images, 1 RTSTRUCT")
+        self.summary.configure(text=f"Loaded {len(cts)} CT images, 1 RTSTRUCT")
 
         # Populate ROI list
         self.listbox.delete(0, tk.END)
@@ -438,7 +2312,9 @@ class ROIApp(ctk.CTk):
             if not (r["contour"].get() or r["fill"].get()):
                 return messagebox.showerror("Error", f"ROI '{r['name']}' needs Contour or Fill.")
 
-        base_out = filedialog.askdirectory(title="Select base output folder", initialdir=self.folder)
+        base_out = filedialog.askdirectory(title="Select base output folder",
+                                           initialdir=self.folder if os.path.isdir(self.folder)
+                                           else os.path.dirname(self.folder))
         if not base_out: return
 
         # Naming for Single mode
@@ -450,9 +2326,8 @@ class ROIApp(ctk.CTk):
                 return messagebox.showerror("Error", "Please enter an Image Set Name for Single ImageSet mode.")
 
         # Build settings
-        settings, roi_names = [], []
+        settings = []
         for r in self.rows:
-            roi_names.append(r["name"])
             choice = r["preset"].get()
             if choice == "Manual Entry":
                 raw = r["uniform"].get().strip()
@@ -474,36 +2349,147 @@ class ROIApp(ctk.CTk):
                 "image_set_name": image_set_name
             })
 
+        # C-STORE destination, if chosen (metrics still go to the output folder)
+        output = OUTPUT_LABELS[self.output.get()]
+        fmt = FORMAT_LABELS[self.format.get()]
+        store = None
+        if output == "store":
+            store = ctk.CTkInputDialog(title="DICOM C-STORE",
+                                       text="Destination (AET@host:port):").get_input()
+            if not store: return
+            try: parse_store_dest(store)
+            except ValueError as e:
+                return messagebox.showerror("Error", str(e))
+
         # Output parent
         ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-        parent = os.path.join(base_out, f"ROIOverrideOutput_{ts}")
+        parent = os.path.join(base_out, f"{OUTPUT_PREFIX}{ts}")
         os.makedirs(parent, exist_ok=True)
         self.summary.configure(text=f"Output → {parent}")
 
-        # Tasks
-        tasks = []
-        if mode == "combine":
-            safe = "_".join(n.replace(" ", "_") for n in roi_names)
-            tasks.append((settings, os.path.join(parent, f"Combined_{safe}")))
+        # Tasks (+ ZIP targets, if chosen)
+        tasks = plan_tasks(settings, mode, parent)
+
+        # Run off the UI thread; _poll_burn shows progress and finishes up
+        self._cancel = threading.Event()
+        self._job = {"frac": 0.0, "text": "Starting…", "result": None,
+                     "parent": parent, "t0": time.monotonic(), "saturated": {}, "store": store}
+        self.burn_btn.configure(state="disabled")
+        self.cancel_btn.configure(state="normal")
+        for b in self.pickers:
+            b.configure(state="disabled")
+        self.progress.set(0)
+        threading.Thread(target=self._burn_worker, args=(self.folder, tasks, output, fmt, self._job, self._cancel),
+                         daemon=True).start()
+        self.after(100, self._poll_burn)
+
+    @_reading_inputs()
+    def _burn_worker(self, folder: str, tasks, output: str, fmt: str, job: dict,
+                     cancel: threading.Event):
+        """Worker thread: decode the CT + rasterize ROIs once, run every task.
+
+        Works only on the arguments captured by burn_in; never touches Tk or self.
+        """
+        # Progress units: loading, ROI masks, 1 per task (burn 30%, write 70%)
+        units = len(tasks) + 2
+        spans = {"burn": (0.0, 0.3), "write": (0.3, 0.7)}
+        def report(unit, label):
+            def cb(stage, done, total):
+                start, width = spans.get(stage, (0.0, 1.0))
+                part = start + width * done / max(total, 1)
+                job["frac"] = (unit + part) / units
+                job["text"] = f"{label}: {stage} {done}/{total} slices"
+            return cb
+
+        try:
+            series = load_ct_series(folder, workers=WORKERS, progress=report(0, "CT"),
+                                    cancel=cancel, cache_dir=CACHE_DIR, metrics=True)
+            labels = build_label_map(folder, [s for cfg, _ in tasks for s in cfg], series,
+                                     workers=WORKERS, progress=report(1, "ROIs"),
+                                     cancel=cancel, cache_dir=CACHE_DIR, metrics=True)
+            job["unmatched"] = {n: c for n, c in labels.unmatched.items() if c}
+            archives = plan_archives(output, tasks, job["parent"])
+            sender = None
+            try:
+                # One association pool for every series of this run
+                if job["store"]:
+                    sender = DicomStore(job["store"])
+                for i, ((cfg, out), archive) in enumerate(zip(tasks, archives)):
+                    if archive is None and sender is None:
+                        os.makedirs(out, exist_ok=True)
+                    stats = {}
+                    run_roi_override(folder, out, cfg, series=series, workers=WORKERS,
+                                     progress=report(i + 2, os.path.basename(out)), cancel=cancel,
+                                     cache_dir=CACHE_DIR, report=stats, labels=labels, metrics=True,
+                                     archive=archive, output_format=fmt, store=sender)
+                    job["saturated"].update(stats["clipped"])
+                    job["summary"] = metrics_summary(stats["metrics"])
+            finally:
+                if output == "zip":
+                    archives[0].close()
+                if sender is not None:
+                    sender.close()
+            job["result"] = "done"
+        except BurnInCancelled:
+            shutil.rmtree(job["parent"], ignore_errors=True)
+            job["result"] = "cancelled"
+        except Exception as e:
+            job["result"] = e
+
+    def _poll_burn(self):
+        """Mirror worker progress + ETA into the UI; finish when it is done."""
+        job = self._job
+        frac = job["frac"]
+        self.progress.set(frac)
+        if self._cancel.is_set():
+            text = "Cancelling…"
         else:
-            for s in settings:
-                tasks.append(([s], os.path.join(parent, s["image_set_name"])))
-
-        # Run
-        total = len(tasks)
-        for i, (cfg, out) in enumerate(tasks):
-            os.makedirs(out, exist_ok=True)
-            run_roi_override(self.folder, out, cfg)
-            self.progress.set((i+1)/total)
-            self.update_idletasks()
+            text = job["text"]
+            if frac > 0.02:
+                left = int((time.monotonic() - job["t0"]) * (1 - frac) / frac)
+                text += f"    ETA {left // 60}:{left % 60:02d}"
+        self.eta.configure(text=text)
+        if job.get("summary"):
+            self.summary.configure(text=job["summary"])
+
+        result = job["result"]
+        if result is None:
+            self.after(100, self._poll_burn)
+            return
+
+        self.burn_btn.configure(state="normal")
+        self.cancel_btn.configure(state="disabled")
+        for b in self.pickers:
+            b.configure(state="normal")
+        if result == "done":
+            msg = f"Burn-in complete!\nAll output saved under:\n{job['parent']}"
+            if job["store"]:
+                msg += f"\nSeries sent by C-STORE to {job['store']}"
+            if job.get("summary"):
+                msg += f"\n\nLast series: {job['summary']}"
+            for roi, c in job["saturated"].items():
+                msg += (f"\n\n{roi}: {c['hu']} HU is outside the pixel range; "
+                        f"clipped to stored value {c['stored']} on {c['slices']} slice(s).")
+            for roi, n in job.get("unmatched", {}).items():
+                msg += f"\n\n{roi}: {n} contour(s) matched no CT slice and were skipped."
+            messagebox.showinfo("Done", msg)
+            self.destroy()
+        elif result == "cancelled":
+            self.progress.set(0)
+            self.eta.configure(text="Cancelled; partial output removed.")
+            self.summary.configure(text="")
+        else:
+            self.eta.configure(text="")
+            messagebox.showerror("Error", f"Burn-in failed:\n{result}")
 
-        messagebox.showinfo("Done", f"Burn-in complete!\nAll output saved under:\n{parent}")
-        self.destroy()
+    def _cancel_burn(self):
+        """Ask the running burn-in to stop; it removes its partial output."""
+        if self._cancel is not None:
+            self._cancel.set()
+            self.cancel_btn.configure(state="disabled")
 
 # ------------------------------
 # Main
 # ------------------------------
 if __name__ == "__main__":
-    ctk.set_appearance_mode("dark")
-    ctk.set_default_color_theme("blue")
-    ROIApp().mainloop()
+    sys.exit(main())
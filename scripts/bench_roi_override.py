@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for roi_override.py on synthetic data (runs offline).
+- Generates a CT series + RTSTRUCT of configurable size
+- Times load, RTSTRUCT parse, densify, rasterize, label map, apply and write
+  from roi_override's own stage metrics
+- Prints / writes JSON results for comparison across versions
+
+  python scripts/bench_roi_override.py --slices 200 --matrix 512 --rois 8 --out bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage, RTStructureSetStorage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import roi_override as ro
+
+# ------------------------------
+# Synthetic data
+# ------------------------------
+def _file_meta(sop_class: str, sop_uid: str) -> FileMetaDataset:
+    fm = FileMetaDataset()
+    fm.MediaStorageSOPClassUID = sop_class
+    fm.MediaStorageSOPInstanceUID = sop_uid
+    fm.TransferSyntaxUID = ExplicitVRLittleEndian
+    return fm
+
+def make_dataset(out_dir: str, slices: int = 100, matrix: int = 512, rois: int = 5,
+                 polys: int = 1, points: int = 64, holes: bool = False,
+                 thickness: float = 2.0, slope: float = 1.0, intercept: float = 0.0,
+                 unsigned: bool = False, seed: int = 0) -> dict:
+    """Write CT.NNNN.dcm slices + RS.bench.dcm into out_dir; returns counts.
+
+    Each ROI has `polys` wobbly polygons of `points` points on every slice
+    (plus an inner hole each when `holes`). FOV is 500 mm. Pixels are
+    stored as (HU - intercept) / slope in int16, or uint16 when `unsigned`
+    (clipped to the type's range).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    study, series, frame = generate_uid(), generate_uid(), generate_uid()
+    ps = 500.0 / matrix
+    ox = oy = -matrix * ps / 2
+    zs = [(i - slices // 2) * thickness for i in range(slices)]
+
+    # Water cylinder + noise in HU, rescaled to the stored type
+    yy, xx = np.mgrid[:matrix, :matrix]
+    body = (xx - matrix / 2) ** 2 + (yy - matrix / 2) ** 2 < (0.4 * matrix) ** 2
+    base = np.where(body, 0, -1000).astype(np.int16)
+    dtype = np.dtype(np.uint16 if unsigned else np.int16)
+    info = np.iinfo(dtype)
+    for i, z in enumerate(zs):
+        sop = generate_uid()
+        ds = Dataset()
+        ds.file_meta = _file_meta(CTImageStorage, sop)
+        ds.SOPClassUID, ds.SOPInstanceUID, ds.Modality = CTImageStorage, sop, "CT"
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study, series, frame
+        ds.PatientID, ds.PatientName, ds.StudyDate = "BENCH", "Bench^Synthetic", "20240101"
+        ds.ImagePositionPatient = [ox, oy, z]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [ps, ps]
+        ds.SliceThickness = thickness
+        ds.Rows = ds.Columns = matrix
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.PixelRepresentation = 0 if unsigned else 1
+        ds.RescaleSlope, ds.RescaleIntercept = slope, intercept
+        ds.InstanceNumber = i + 1
+        hu = base + rng.integers(-20, 20, base.shape, dtype=np.int16)
+        stored = np.clip(np.rint((hu - intercept) / slope), info.min, info.max)
+        ds.PixelData = stored.astype(dtype).tobytes()
+        ds.save_as(os.path.join(out_dir, f"CT.{i:04d}.dcm"), **ro._FILE_FORMAT)
+
+    rs = Dataset()
+    rs.file_meta = _file_meta(RTStructureSetStorage, generate_uid())
+    rs.SOPClassUID, rs.SOPInstanceUID = RTStructureSetStorage, rs.file_meta.MediaStorageSOPInstanceUID
+    rs.Modality, rs.StudyInstanceUID, rs.SeriesInstanceUID = "RTSTRUCT", study, generate_uid()
+    rs.PatientID, rs.PatientName = "BENCH", "Bench^Synthetic"
+    se = Dataset(); se.SeriesInstanceUID = series
+    st = Dataset(); st.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+    st.ReferencedSOPInstanceUID = study; st.RTReferencedSeriesSequence = Sequence([se])
+    rf = Dataset(); rf.FrameOfReferenceUID = frame; rf.RTReferencedStudySequence = Sequence([st])
+    rs.ReferencedFrameOfReferenceSequence = Sequence([rf])
+
+    ssr, rcs, n_contours = [], [], 0
+    t = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    for num in range(1, rois + 1):
+        r = Dataset(); r.ROINumber = num; r.ROIName = f"ROI_{num}"
+        r.ReferencedFrameOfReferenceUID = frame
+        ssr.append(r)
+        centers = rng.uniform(-0.25, 0.25, (polys, 2)) * matrix * ps
+        radii = rng.uniform(0.03, 0.12, polys) * matrix * ps
+        cs = []
+        for z in zs:
+            for (cx, cy), rad in zip(centers, radii):
+                for scale in ((1.0, 0.4) if holes else (1.0,)):
+                    wob = 1 + 0.15 * np.sin(3 * t + z + num)
+                    x = cx + scale * rad * wob * np.cos(t)
+                    y = cy + scale * rad * wob * np.sin(t)
+                    c = Dataset(); c.ContourGeometricType = "CLOSED_PLANAR"
+                    c.NumberOfContourPoints = points
+                    c.ContourData = np.column_stack([x, y, np.full(points, z)]).round(3).ravel().tolist()
+                    cs.append(c)
+        rc = Dataset(); rc.ReferencedROINumber = num; rc.ContourSequence = Sequence(cs)
+        rcs.append(rc)
+        n_contours += len(cs)
+    rs.StructureSetROISequence = Sequence(ssr)
+    rs.ROIContourSequence = Sequence(rcs)
+    rs.save_as(os.path.join(out_dir, "RS.bench.dcm"), **ro._FILE_FORMAT)
+    return {"slices": slices, "contours": n_contours}
+
+# ------------------------------
+# Timed stages
+# ------------------------------
+def run_once(folder: str, out_dir: str, settings: list[dict], mode: str, workers: int) -> dict:
+    """One timed pass over every stage → {stage: seconds}, from the stats
+    roi_override records itself (series/labels stats, metrics logs)."""
+    series = ro.load_ct_series(folder, workers=workers)
+    labels = ro.build_label_map(folder, settings, series, workers=workers)
+    times = {"load": series.stats["seconds"],
+             "parse": labels.stats["parse_seconds"],
+             "densify": labels.stats["densify_seconds"],
+             "rasterize": labels.stats["rasterize_seconds"],
+             "label_map": labels.stats["seconds"],
+             "apply": 0.0, "write": 0.0}
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    t0 = time.perf_counter()
+    for cfg, out in ro.plan_tasks(settings, mode, out_dir):
+        report = {}
+        ro.run_roi_override(folder, out, cfg, series=series, labels=labels,
+                            workers=workers, report=report, metrics=True)
+        stages = report["metrics"]["stages"]
+        times["apply"] += stages["burn"]["seconds"]
+        times["write"] += stages["write"]["seconds"]
+    times["export"] = time.perf_counter() - t0
+    return times
+
+def _git_rev() -> "str | None":
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv: "list[str] | None" = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark roi_override on synthetic CT + RTSTRUCT data.")
+    ap.add_argument("--slices", type=int, default=100)
+    ap.add_argument("--matrix", type=int, default=512, help="rows = columns (e.g. 512, 1024)")
+    ap.add_argument("--rois", type=int, default=5)
+    ap.add_argument("--polys", type=int, default=1, help="polygons per ROI per slice")
+    ap.add_argument("--points", type=int, default=64, help="points per contour")
+    ap.add_argument("--holes", action="store_true", help="add an inner hole to every polygon")
+    ap.add_argument("--slope", type=float, default=1.0, help="RescaleSlope of the CT slices")
+    ap.add_argument("--intercept", type=float, default=0.0, help="RescaleIntercept of the CT slices")
+    ap.add_argument("--uint16", action="store_true", help="store pixels unsigned (e.g. with --intercept -1024)")
+    ap.add_argument("--mode", choices=("combine", "separate"), default="combine")
+    ap.add_argument("--workers", type=int, default=ro.WORKERS)
+    ap.add_argument("--repeat", type=int, default=3, help="timed passes (best is reported)")
+    ap.add_argument("--data", help="keep/reuse the synthetic data in this folder")
+    ap.add_argument("--out", help="write JSON results here (default: stdout only)")
+    args = ap.parse_args(argv)
+
+    work = tempfile.mkdtemp(prefix="roi_bench_")
+    try:
+        data = args.data or os.path.join(work, "data")
+        if not (os.path.isdir(data) and ro.find_dicom_files(data)[0]):
+            make_dataset(data, args.slices, args.matrix, args.rois, args.polys,
+                         args.points, args.holes, slope=args.slope,
+                         intercept=args.intercept, unsigned=args.uint16)
+        n_slices = len(ro.find_dicom_files(data)[0])
+        settings = [{"roi_name": f"ROI_{k}", "contour": k % 2 == 0, "fill": True,
+                     "uniform": 100 * k, "image_set_name": "Bench"}
+                    for k in range(1, args.rois + 1)]
+        if args.mode == "separate":
+            for s in settings:
+                s["image_set_name"] = s["roi_name"]
+
+        runs = [run_once(data, os.path.join(work, "out"), settings, args.mode, args.workers)
+                for _ in range(args.repeat)]
+        best = {k: round(min(r[k] for r in runs), 4) for k in runs[0]}
+        result = {
+            "config": {k: getattr(args, k) for k in
+                       ("slices", "matrix", "rois", "polys", "points", "holes", "slope",
+                        "intercept", "uint16", "mode", "workers", "repeat")},
+            "version": _git_rev(),
+            "env": {"python": platform.python_version(), "numpy": np.__version__,
+                    "pydicom": pydicom.__version__, "machine": platform.machine(),
+                    "cpus": os.cpu_count()},
+            "seconds": best,
+            "slices_per_s": round(n_slices / best["export"], 1) if best["export"] else None,
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
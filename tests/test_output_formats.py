@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Output encoders: rle_frame decoded back by pydicom's RLE decoder, and the
+Enhanced CT writer (frame order, positions, pixels) on synthetic data.
+
+  python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import RLELossless, EnhancedCTImageStorage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+import roi_override as ro
+from bench_roi_override import make_dataset
+
+def rle_decode(pixels: np.ndarray) -> np.ndarray:
+    """pixels → rle_frame → pydicom's RLE Lossless decoder."""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = RLELossless
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+    ds.BitsAllocated = ds.BitsStored = pixels.dtype.itemsize * 8
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = int(pixels.dtype.kind == "i")
+    ds.PixelData = encapsulate([ro.rle_frame(pixels)])
+    return ds.pixel_array.reshape(pixels.shape)
+
+def images(dtype, rng: np.random.Generator):
+    """Single rows, width 1, runs up to and past 128, noise and mixed runs."""
+    info = np.iinfo(dtype)
+    yield np.full((1, 300), info.max, dtype)
+    yield np.full((1, 1), info.min, dtype)
+    yield np.zeros((5, 1), dtype)
+    yield np.full((3, 257), 7, dtype)
+    for _ in range(40):
+        h, w = int(rng.integers(1, 12)), int(rng.integers(1, 300))
+        if rng.random() < 0.2:    # literal-only noise
+            yield rng.integers(info.min, info.max, (h, w), dtype=dtype, endpoint=True)
+            continue
+        n = 64
+        values = rng.integers(info.min, info.max, n, dtype=dtype, endpoint=True)
+        lens = rng.choice([1, 1, 2, 3, 4, 127, 128, 129, 130, 300], n)
+        yield np.resize(np.repeat(values, lens), (h, w)).astype(dtype)
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+def test_rle_round_trip(dtype):
+    rng = np.random.default_rng(np.dtype(dtype).num)
+    for img in images(dtype, rng):
+        got = rle_decode(img)
+        assert got.dtype == img.dtype and np.array_equal(got, img), img.shape
+
+def test_enhanced_frames(tmp_path):
+    data = tmp_path / "in"
+    make_dataset(str(data), slices=6, matrix=32, rois=2)
+    # Files in descending z: frames must still come out sorted along the normal
+    names = sorted(os.listdir(data))
+    cts = [n for n in names if n.startswith("CT.")]
+    for k, name in enumerate(cts):
+        os.rename(data / name, data / f"CT.x{len(cts) - k:04d}.dcm")
+    settings = [{"roi_name": "ROI_1", "contour": False, "fill": True, "uniform": 500,
+                 "image_set_name": "E"}]
+    ro.run_roi_override(str(data), str(tmp_path / "ct"), settings)
+    ro.run_roi_override(str(data), str(tmp_path / "enh"), settings, output_format="enhanced")
+
+    ct = sorted((pydicom.dcmread(p) for p in (tmp_path / "ct").iterdir()),
+                key=lambda d: float(d.ImagePositionPatient[2]))
+    enh = pydicom.dcmread(tmp_path / "enh" / "CT.enhanced.dcm")
+    assert enh.SOPClassUID == EnhancedCTImageStorage
+    assert int(enh.NumberOfFrames) == len(ct)
+    shared = enh.SharedFunctionalGroupsSequence[0]
+    assert list(shared.PixelMeasuresSequence[0].PixelSpacing) == list(ct[0].PixelSpacing)
+
+    frames = enh.pixel_array
+    for k, (d, groups) in enumerate(zip(ct, enh.PerFrameFunctionalGroupsSequence)):
+        position = groups.PlanePositionSequence[0].ImagePositionPatient
+        assert [float(v) for v in position] == pytest.approx([float(v) for v in d.ImagePositionPatient])
+        assert groups.FrameContentSequence[0].InStackPositionNumber == k + 1
+        scale = groups.PixelValueTransformationSequence[0]
+        hu = frames[k] * float(scale.RescaleSlope) + float(scale.RescaleIntercept)
+        assert np.array_equal(hu, d.pixel_array * float(d.RescaleSlope) + float(d.RescaleIntercept))
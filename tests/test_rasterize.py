@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+rasterize_polygons vs the former Pillow path (ImageDraw.polygon per
+polygon, XOR-ed), on random polygon sets. Skipped without Pillow.
+
+  python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+from PIL import ImageChops, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import roi_override as ro
+
+def pil_mask(polys: list, shape: tuple[int, int]) -> np.ndarray:
+    """The pre-NumPy fill: each polygon drawn with outline + fill, XOR-ed."""
+    H, W = shape
+    mask = Image.new("1", (W, H), 0)
+    for poly in polys:
+        tmp = Image.new("1", (W, H), 0)
+        ImageDraw.Draw(tmp).polygon([tuple(map(int, p)) for p in poly], outline=1, fill=1)
+        mask = ImageChops.logical_xor(mask, tmp)
+    return np.array(mask, dtype=bool)
+
+def random_polys(rng: np.random.Generator, shape: tuple[int, int]) -> list:
+    """1–4 polygons: star-like blobs, thin slivers, self-intersecting or
+    partly off-frame shapes, and degenerate 2-point ones."""
+    H, W = shape
+    polys = []
+    for _ in range(rng.integers(1, 5)):
+        kind = rng.integers(4)
+        n = int(rng.integers(2, 40))
+        if kind == 0:       # star-like blob around a centre
+            t = np.sort(rng.uniform(0, 2 * np.pi, n))
+            r = rng.uniform(2, min(H, W) / 2, n)
+            c = rng.uniform(0, [W, H])
+            pts = c + np.column_stack([r * np.cos(t), r * np.sin(t)])
+        elif kind == 1:     # random points anywhere (self-intersecting)
+            pts = rng.uniform(-5, [W + 5, H + 5], (n, 2))
+        elif kind == 2:     # thin sliver
+            a = rng.uniform(0, [W, H])
+            pts = np.array([a, a + rng.uniform(-30, 30, 2), a + rng.uniform(-1, 1, 2)])
+        else:               # small shape, possibly off-frame
+            pts = rng.uniform(-20, [W + 20, H + 20]) + rng.uniform(-4, 4, (n, 2))
+        polys.append(np.rint(pts).astype(np.int32))
+    return polys
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_pillow(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(50):
+        shape = (int(rng.integers(8, 96)), int(rng.integers(8, 96)))
+        polys = random_polys(rng, shape)
+        got = ro.rasterize_polygons(polys, shape)
+        assert np.array_equal(got, pil_mask(polys, shape)), [p.tolist() for p in polys]
+
+def test_nested_hole():
+    square = lambda a, b: np.array([[a, a], [b, a], [b, b], [a, b]])
+    got = ro.rasterize_polygons([square(2, 20), square(8, 14)], (24, 24))
+    assert np.array_equal(got, pil_mask([square(2, 20), square(8, 14)], (24, 24)))
+    assert got[5, 5] and not got[11, 11]
+
+def test_empty():
+    assert not ro.rasterize_polygons([], (4, 4)).any()
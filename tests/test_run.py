@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+run_roi_override end to end on synthetic data (scripts/bench_roi_override.py):
+serial, thread pool, process pool and streaming runs write the same
+pixels; slices no ROI touches keep their original pixel bytes; targets
+beyond BitsStored saturate and are reported.
+
+  python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pydicom
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+import roi_override as ro
+from bench_roi_override import make_dataset
+
+SETTINGS = [
+    {"roi_name": "ROI_1", "contour": False, "fill": True, "uniform": 500, "image_set_name": "T"},
+    {"roi_name": "ROI_2", "contour": True, "fill": True, "uniform": 3000, "image_set_name": "T"},
+    {"roi_name": "ROI_3", "contour": True, "fill": False, "uniform": -1000, "image_set_name": "T"},
+]
+
+@pytest.fixture(scope="module")
+def data(tmp_path_factory):
+    """8 slices, 3 ROIs with holes; no contours on the two lowest slices."""
+    folder = tmp_path_factory.mktemp("in")
+    make_dataset(str(folder), slices=8, matrix=48, rois=3, polys=2, holes=True)
+    rs_path = folder / "RS.bench.dcm"
+    rs = pydicom.dcmread(rs_path)
+    zs = sorted({float(c.ContourData[2]) for rc in rs.ROIContourSequence for c in rc.ContourSequence})
+    for rc in rs.ROIContourSequence:
+        rc.ContourSequence = [c for c in rc.ContourSequence if float(c.ContourData[2]) > zs[1]]
+    rs.save_as(rs_path)
+    return folder, zs[:2]
+
+def run(src, out, **kwargs) -> dict:
+    """{file name: dataset} of one run_roi_override output folder."""
+    ro.run_roi_override(str(src), str(out), SETTINGS, **kwargs)
+    return {name: pydicom.dcmread(os.path.join(out, name)) for name in sorted(os.listdir(out))}
+
+@pytest.mark.parametrize("kwargs", [{"workers": 3}, {"workers": 2, "processes": True},
+                                    {"streaming": True}, {"streaming": True, "workers": 3}],
+                         ids=["threads", "processes", "streaming", "streaming-threads"])
+def test_same_as_serial(data, tmp_path, kwargs):
+    src, _ = data
+    serial = run(src, tmp_path / "serial")
+    other = run(src, tmp_path / "other", **kwargs)
+    assert list(other) == list(serial)
+    for name, ds in serial.items():
+        assert other[name].PixelData == ds.PixelData, name
+        for kw in ("RescaleSlope", "RescaleIntercept", "WindowCenter", "WindowWidth"):
+            assert other[name].get(kw) == ds.get(kw), (name, kw)
+
+def test_untouched_slices_keep_pixels(data, tmp_path):
+    src, empty_zs = data
+    sources = {float(d.ImagePositionPatient[2]): d for d in
+               (pydicom.dcmread(src / n) for n in os.listdir(src) if n.startswith("CT."))}
+    out = run(src, tmp_path / "out")
+    assert len(out) == len(sources)
+    for ds in out.values():
+        z = float(ds.ImagePositionPatient[2])
+        if z in empty_zs:
+            assert ds.PixelData == sources[z].PixelData
+        else:
+            assert ds.PixelData != sources[z].PixelData
+        assert ds.SOPInstanceUID != sources[z].SOPInstanceUID
+
+def test_saturates_to_bits_stored(tmp_path):
+    src = tmp_path / "in"
+    make_dataset(str(src), slices=3, matrix=32, rois=1, intercept=-1024, unsigned=True)
+    for name in os.listdir(src):
+        if name.startswith("CT."):
+            ds = pydicom.dcmread(src / name)
+            ds.BitsStored, ds.HighBit = 12, 11
+            ds.save_as(src / name)
+    report = {}
+    ro.run_roi_override(str(src), str(tmp_path / "out"),
+                        [{"roi_name": "ROI_1", "contour": False, "fill": True, "uniform": 7000,
+                          "image_set_name": "T"}], report=report)
+    assert report["clipped"]["ROI_1"]["stored"] == 4095
+    assert report["clipped"]["ROI_1"]["slices"] == 3
+    for name in os.listdir(tmp_path / "out"):
+        assert pydicom.dcmread(tmp_path / "out" / name).pixel_array.max() == 4095